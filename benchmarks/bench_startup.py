@@ -0,0 +1,142 @@
+"""
+Measures the import time of the anatomy modules with "python -X importtime", in fresh interpreters.
+
+Usage:
+    python -m benchmarks.bench_startup --output startup.json
+    python -m benchmarks.bench_startup --baseline startup.json --threshold 0.2
+
+Exits with 1 when any module imports one of the DEFERRED modules (which must only be imported when used) or is slower
+than the baseline by more than the threshold. The results use the same format as benchmarks.suite.
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+
+from benchmarks.suite import RESULTS_VERSION, compare
+
+MODULES = [
+    "zops.anatomy.layers.tree",
+    "zops.anatomy.layers.playbook",
+    "zops.anatomy.cli",
+]
+
+# Modules that must not be imported at startup: either expensive or not needed by most commands.
+DEFERRED = ["distutils", "pkg_resources", "ansible", "jinja2", "stringcase", "yaml"]
+
+
+def import_times(module):
+    """
+    Imports the given module in a new interpreter.
+
+    :param str module:
+    :return dict(str:int):
+        Returns the cumulative import time, in microseconds, of each module imported.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+
+    result = {}
+    for i_line in process.stderr.splitlines():
+        if not i_line.startswith("import time:"):
+            continue
+        _self_time, cumulative, name = i_line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            result[name.strip()] = int(cumulative)
+    return result
+
+
+def run_benchmarks(modules, repeat=10):
+    """
+    :param list(str) modules:
+    :param int repeat:
+    :return dict:
+        The results (see benchmarks.suite.run_benchmarks) plus the deferred modules imported by each module.
+    """
+    results = {}
+    deferred = {}
+    for i_module in modules:
+        times = []
+        for _j in range(repeat):
+            imported = import_times(i_module)
+            times.append(imported[i_module] / 1e6)
+        results[i_module] = dict(
+            min=min(times), median=statistics.median(times), repeat=repeat
+        )
+        deferred[i_module] = sorted(
+            i for i in imported if i.split(".")[0] in DEFERRED
+        )
+    return dict(
+        version=RESULTS_VERSION,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        parameters=dict(modules=modules),
+        results=results,
+        deferred=deferred,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--module",
+        action="append",
+        help="Measure only this module (can be repeated).",
+    )
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--output", help="Save the results in this JSON file.")
+    parser.add_argument("--baseline", help="Compare with the results in this file.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slowdown considered a regression (default: 0.2).",
+    )
+    args = parser.parse_args(argv)
+
+    modules = []
+    for i_module in args.module or MODULES:
+        try:
+            import_times(i_module)
+        except RuntimeError as e:
+            print("WARNING: Skipping {}: {}".format(i_module, e))
+        else:
+            modules.append(i_module)
+    results = run_benchmarks(modules, args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as oss:
+            json.dump(results, oss, indent=1, sort_keys=True)
+
+    failed = False
+    for i_module, i_deferred in results["deferred"].items():
+        if i_deferred:
+            print("{} imports {}".format(i_module, ", ".join(i_deferred)))
+            failed = True
+
+    if args.baseline:
+        with open(args.baseline) as iss:
+            baseline = json.load(iss)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions: {}".format(", ".join(regressions)))
+            failed = True
+    else:
+        for i_name, i_result in results["results"].items():
+            print(
+                "{:<32} {:>8.2f}ms (median {:.2f}ms)".format(
+                    i_name, i_result["min"] * 1e3, i_result["median"] * 1e3
+                )
+            )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,65 @@
+"""
+Compares the cost of accumulating feature variables with merge_dict and with AnatomyVariables.
+
+Usage:
+    python -m benchmarks.bench_variables
+"""
+import timeit
+
+from zops.anatomy.layers.tree import AnatomyVariables, merge_dict
+
+
+def make_features(count, variables_per_feature=20):
+    """
+    Returns the variables layers added by each feature: its use-features (left_join) and its own variables.
+    """
+    result = []
+    for i in range(count):
+        name = "FEATURE_{}".format(i)
+        variables = {
+            name: {
+                "var_{}".format(j): "value {}".format(j)
+                for j in range(variables_per_feature)
+            }
+        }
+        variables[name]["items"] = ["item_{}".format(i)]
+        use_features = {}
+        if i > 0:
+            use_features["FEATURE_{}".format(i - 1)] = {"var_0": "override"}
+        result.append((use_features, variables))
+    return result
+
+
+def merge_with_merge_dict(features):
+    result = {}
+    for i_use_features, i_variables in features:
+        result = merge_dict(result, i_use_features, left_join=True)
+        result = merge_dict(result, i_variables, left_join=False)
+    return result
+
+
+def merge_with_layers(features):
+    result = AnatomyVariables()
+    for i_use_features, i_variables in features:
+        result.add(i_use_features, left_join=True)
+        result.add(i_variables, left_join=False)
+    return result.materialize()
+
+
+def main():
+    print("{:>10} {:>22} {:>22}".format("features", "merge_dict (us/feat)", "layers (us/feat)"))
+    for i_count in (10, 50, 100, 200, 400):
+        features = make_features(i_count)
+        assert merge_with_merge_dict(features) == merge_with_layers(features)
+        times = []
+        for i_function in (merge_with_merge_dict, merge_with_layers):
+            number = 3
+            elapsed = min(
+                timeit.repeat(lambda: i_function(features), number=number, repeat=3)
+            )
+            times.append(elapsed / number / i_count * 1e6)
+        print("{:>10} {:>22.1f} {:>22.1f}".format(i_count, *times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Times the main operations of the anatomy engine on a synthetic project (see SyntheticProject), saving the results as
+JSON and comparing them with a baseline.
+
+Usage:
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --baseline results.json --threshold 0.2
+
+Exits with 1 when any benchmark is slower than the baseline by more than the threshold. The baseline timings are only
+meaningful on the machine (and Python version) that produced them.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+
+from benchmarks.bench_variables import (
+    make_features,
+    merge_with_layers,
+    merge_with_merge_dict,
+)
+from benchmarks.synthetic import SyntheticProject
+
+RESULTS_VERSION = 1
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark. The decorated function receives the project and a work directory and returns the
+    function to time, called once per repetition, or a (setup, function) tuple: setup is called (untimed) before each
+    repetition and its result is passed to the function.
+    """
+
+    def decorator(function):
+        BENCHMARKS[name] = function
+        return function
+
+    return decorator
+
+
+@benchmark("expand")
+def bench_expand(project, work_dir):
+    from zops.anatomy.layers.tree import TemplateEngine
+
+    engine = TemplateEngine.get()
+    variables = _create_tree(project, work_dir)._get_variables(None)
+    texts = [
+        project.contents(i_feature, 0) for i_feature in range(project.features)
+    ]
+
+    def run():
+        for i_text in texts:
+            engine.expand(i_text, variables)
+
+    return run
+
+
+@benchmark("merge_dict")
+def bench_merge_dict(project, work_dir):
+    features = make_features(project.features)
+    return lambda: merge_with_merge_dict(features)
+
+
+@benchmark("anatomy_variables")
+def bench_anatomy_variables(project, work_dir):
+    features = make_features(project.features)
+    return lambda: merge_with_layers(features)
+
+
+@benchmark("using_features")
+def bench_using_features(project, work_dir):
+    from collections import OrderedDict
+
+    templates_dir = _templates_dir(work_dir)
+    name = project.feature_name(project.features - 1)
+
+    def run(registry):
+        # A new registry for each repetition, since the closures are memoized.
+        registry.get(name).using_features(OrderedDict(), registry=registry)
+
+    return lambda: project.registry(templates_dir), run
+
+
+@benchmark("tree_apply")
+def bench_tree_apply(project, work_dir):
+    tree = _create_tree(project, work_dir)
+    target_dir = os.path.join(work_dir, "tree")
+
+    def setup():
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+    return setup, lambda _: tree.apply(target_dir)
+
+
+@benchmark("playbook_apply")
+def bench_playbook_apply(project, work_dir):
+    templates_dir = _templates_dir(work_dir)
+    target_dir = os.path.join(work_dir, "playbook")
+
+    def setup():
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+    def run(_):
+        registry = project.registry(templates_dir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            project.playbook(registry).apply(target_dir)
+
+    return setup, run
+
+
+def _templates_dir(work_dir):
+    return os.path.join(work_dir, "templates")
+
+
+def _create_tree(project, work_dir):
+    """
+    Returns the tree of a playbook apply, with all project features.
+    """
+    from zops.anatomy.layers.tree import AnatomyTree
+
+    registry = project.registry(_templates_dir(work_dir))
+    result = AnatomyTree()
+    names = ["ANATOMY"]
+    names += registry.closure(project.feature_name(project.features - 1))
+    for i_name in names:
+        registry.get(i_name).apply(result)
+    return result
+
+
+def run_benchmarks(project, names=None, repeat=5):
+    """
+    :param SyntheticProject project:
+    :param list(str) names:
+        The benchmarks to run. Defaults to all.
+    :param int repeat:
+    :return dict:
+        The results, as saved in the JSON file.
+    """
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="anatomy-benchmarks-")
+    try:
+        project.write_templates(_templates_dir(work_dir))
+        for i_name in names or BENCHMARKS:
+            times = _time(BENCHMARKS[i_name](project, work_dir), repeat)
+            results[i_name] = dict(
+                min=min(times), median=statistics.median(times), repeat=repeat
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return dict(
+        version=RESULTS_VERSION,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        parameters=dict(
+            features=project.features, files=project.files, depth=project.depth
+        ),
+        results=results,
+    )
+
+
+def _time(benchmark_function, repeat, min_time=0.05):
+    """
+    Times the given benchmark (see benchmark) after a warm-up call.
+
+    Benchmarks without setup are called many times in each repetition, so each repetition takes at least min_time.
+
+    :return list(float):
+        Returns the time, in seconds, of one call in each repetition.
+    """
+    if isinstance(benchmark_function, tuple):
+        setup, function = benchmark_function
+        number = 1
+    else:
+        setup = lambda: None
+        function = lambda _: benchmark_function()
+        number = None
+
+    function(setup())
+    result = []
+    for _i in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        if number is None:
+            number = 0
+            while time.perf_counter() - start < min_time:
+                function(state)
+                number += 1
+        else:
+            for _j in range(number):
+                function(state)
+        result.append((time.perf_counter() - start) / number)
+    return result
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares the minimum times of the results with the baseline.
+
+    :param dict results:
+    :param dict baseline:
+    :param float threshold:
+        The relative slowdown (eg.: 0.2 for 20%) considered a regression.
+    :return list(str):
+        Returns the names of the benchmarks that regressed.
+    """
+    if baseline.get("parameters") != results["parameters"]:
+        print(
+            "WARNING: Baseline parameters differ: {}".format(baseline.get("parameters"))
+        )
+
+    regressions = []
+    print(
+        "{:<20} {:>12} {:>12} {:>8}".format("benchmark", "baseline", "current", "ratio")
+    )
+    for i_name, i_result in results["results"].items():
+        try:
+            baseline_time = baseline["results"][i_name]["min"]
+        except KeyError:
+            continue
+        ratio = i_result["min"] / baseline_time
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(i_name)
+            flag = " REGRESSION"
+        print(
+            "{:<20} {:>10.2f}ms {:>10.2f}ms {:>8.2f}{}".format(
+                i_name, baseline_time * 1e3, i_result["min"] * 1e3, ratio, flag
+            )
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--features", type=int, default=20)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--benchmark",
+        action="append",
+        choices=sorted(BENCHMARKS),
+        help="Run only this benchmark (can be repeated).",
+    )
+    parser.add_argument("--output", help="Save the results in this JSON file.")
+    parser.add_argument("--baseline", help="Compare with the results in this file.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slowdown considered a regression (default: 0.2).",
+    )
+    args = parser.parse_args(argv)
+
+    project = SyntheticProject(args.features, args.files, args.depth)
+    results = run_benchmarks(project, args.benchmark, args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as oss:
+            json.dump(results, oss, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as iss:
+            baseline = json.load(iss)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions: {}".format(", ".join(regressions)))
+            return 1
+    else:
+        for i_name, i_result in results["results"].items():
+            print(
+                "{:<20} {:>10.2f}ms (median {:.2f}ms)".format(
+                    i_name, i_result["min"] * 1e3, i_result["median"] * 1e3
+                )
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,144 @@
+"""
+Generates synthetic anatomy projects for the benchmarks.
+
+A project has N features with M files each. The variables of each feature are nested D levels deep. Each feature uses
+the previous one (so the dependency closures grow with N), creates contents files, "!template" files (from the
+templates directory) and a symlink.
+
+Usage:
+    project = SyntheticProject(features=20, files=10, depth=3)
+    project.write_templates('templates')
+    registry = project.registry('templates')
+    playbook = project.playbook(registry)
+"""
+import copy
+import os
+
+
+class SyntheticProject(object):
+    def __init__(self, features=20, files=10, depth=3):
+        self.features = features
+        self.files = files
+        self.depth = depth
+
+    @staticmethod
+    def feature_name(index):
+        return "FEATURE_{}".format(index)
+
+    def variables(self, index):
+        """
+        Returns the variables of the given feature: a list of services and a value nested depth levels.
+        """
+        value = {"value": "value {}".format(index), "enabled": str(index % 2 == 0)}
+        for i_level in reversed(range(self.depth)):
+            value = {"level_{}".format(i_level): value}
+        value["services"] = ["item_{}".format(i) for i in range(10)]
+        value["name"] = "{{ 'feature %d' | upper }}" % index
+        return value
+
+    def variable_path(self, index):
+        name = self.feature_name(index)
+        levels = ["level_{}".format(i) for i in range(self.depth)]
+        return ".".join([name] + levels)
+
+    def contents(self, index, file_index):
+        """
+        Returns the contents of a file, using the feature variables, filters and a loop.
+        """
+        name = self.feature_name(index)
+        path = self.variable_path(index)
+        return "\n".join(
+            [
+                "# File {} of {{{{ {}.name }}}}".format(file_index, name),
+                "value: {{{{ {}.value }}}}".format(path),
+                "{{% if {} | is_enabled %}}enabled{{% endif %}}".format(path),
+                "{{% for i in {}.services %}}".format(name),
+                "  - {{ i | dashcase }} {{ i | expandit }}",
+                "{% endfor %}",
+            ]
+        )
+
+    def template_name(self, file_index):
+        return "template_{}.txt".format(file_index)
+
+    def write_templates(self, templates_dir):
+        """
+        Writes the templates used by the "!template" files in the given templates directory. The templates are shared
+        by all features, using the variables of the first one.
+
+        :param str templates_dir:
+        """
+        directory = os.path.join(templates_dir, "application")
+        os.makedirs(directory, exist_ok=True)
+        for i_file in range(self.files):
+            if not self._is_template(i_file):
+                continue
+            with open(os.path.join(directory, self.template_name(i_file)), "w") as oss:
+                oss.write(self.contents(0, i_file))
+
+    def features_contents(self):
+        """
+        :return dict:
+            The contents of an anatomy-features file.
+        """
+        features = []
+        for i_feature in range(self.features):
+            name = self.feature_name(i_feature)
+            create_files = []
+            for j_file in range(self.files):
+                filename = "{}/file_{}.txt".format(name.lower(), j_file)
+                if self._is_template(j_file):
+                    create_files.append(
+                        {"filename": filename, "template": self.template_name(j_file)}
+                    )
+                else:
+                    create_files.append(
+                        {"filename": filename, "contents": self.contents(i_feature, j_file)}
+                    )
+            create_files.append(
+                {"filename": "{}/link.txt".format(name.lower()), "symlink": "file_0.txt"}
+            )
+            feature = {
+                "name": name,
+                "variables": self.variables(i_feature),
+                "create-files": create_files,
+            }
+            if i_feature > 0:
+                feature["use-features"] = {
+                    self.feature_name(i_feature - 1): {"name": "used by " + name}
+                }
+            features.append(feature)
+        return {"anatomy-features": features}
+
+    def playbook_contents(self):
+        """
+        :return dict:
+            The contents of an anatomy-playbook using the last feature (and, through it, all others).
+        """
+        return {
+            "anatomy-playbook": {
+                "use-features": {self.feature_name(self.features - 1): {}}
+            }
+        }
+
+    def registry(self, templates_dir):
+        """
+        :return AnatomyFeatureRegistry:
+            A new registry with the project features.
+        """
+        from zops.anatomy.layers.feature import AnatomyFeatureRegistry
+
+        result = AnatomyFeatureRegistry()
+        result.register_from_contents(self.features_contents(), templates_dir)
+        return result
+
+    def playbook(self, registry):
+        from zops.anatomy.layers.playbook import AnatomyPlaybook
+
+        return AnatomyPlaybook.from_contents(
+            copy.deepcopy(self.playbook_contents()), registry=registry
+        )
+
+    @staticmethod
+    def _is_template(file_index):
+        return file_index % 3 == 2
@@ -24,13 +24,11 @@ setup(
     keywords="development environment, shell, operations",
     include_package_data=True,
     packages=["zops", "zops.anatomy"],
-    namespace_packages=["zops"],
     entry_points="""
         [zops.plugins]
         main=zops.anatomy.cli:main
     """,
     install_requires=[
-        "ansible",  # Just to use the filter 'combine'.
         "zerotk.lib",
         "zerotk.zops",
         "jinja2",
@@ -337,7 +337,6 @@ def test_use_features_is_dict(anatomy_checker):
         )
 
 
-@pytest.mark.xfail
 def test_use_features_condition(anatomy_checker):
     """
     Testing condition attribute.
@@ -371,6 +370,116 @@ def test_use_features_condition(anatomy_checker):
     )
 
 
+def test_use_features_condition_defaults(anatomy_checker):
+    """
+    Conditions see the feature defaults and the playbook variables, but not the variables set through use-features:
+    these are merged only after the disabled features are dropped. Here the file sees python 'bravo', while the
+    condition sees the default 'alpha'.
+    """
+    anatomy_checker.check(
+        """
+            anatomy-features:
+              - name: PROJECT
+                variables:
+                  python: alpha
+              - name: USER
+                use-features:
+                  PROJECT:
+                    python: bravo
+                create-file:
+                  filename: user.txt
+                  contents: "{{ PROJECT.python }}"
+              - name: OPTIONAL
+                condition: PROJECT.python == 'bravo'
+                create-file:
+                  filename: optional.txt
+                  contents: Optional.
+            anatomy-playbook:
+              use-features:
+                USER: {}
+                OPTIONAL: {}
+            target:
+              user.txt: |
+                bravo
+              optional.txt: "!"
+        """
+    )
+
+
+def test_use_features_condition_undefined(anatomy_checker):
+    """
+    Raise an error when a condition uses an undefined variable, instead of dropping the feature.
+    """
+    with pytest.raises(RuntimeError, match="BRAVO: condition PROJET.python"):
+        anatomy_checker.check(
+            """
+                anatomy-features:
+                  - name: PROJECT
+                    variables:
+                      python: alpha
+                  - name: BRAVO
+                    condition: PROJET.python == 'alpha'
+                    create-file:
+                      filename: bravo.txt
+                      contents: This is Bravo.
+                anatomy-playbook:
+                  use-features:
+                    PROJECT: {}
+                    BRAVO: {}
+                target: {}
+            """
+        )
+
+
+@pytest.mark.parametrize("python, expected", [("alpha", "!"), ("bravo", "Base.")])
+def test_use_features_condition_drops_subtree(anatomy_checker, python, expected):
+    """
+    A feature with a False condition is dropped with the features used only by it. Features used by enabled features
+    keep their variables, but create no files.
+    """
+    anatomy_checker.check(
+        f"""
+            anatomy-features:
+              - name: PROJECT
+                variables:
+                  python: alpha
+              - name: BASE
+                create-file:
+                  filename: base.txt
+                  contents: Base.
+              - name: OPTIONAL
+                condition: PROJECT.python == 'bravo'
+                use-features:
+                  BASE: {{}}
+                create-file:
+                  filename: optional.txt
+                  contents: Optional.
+              - name: REQUIRED
+                condition: "false"
+                variables:
+                  name: required
+              - name: USER
+                use-features:
+                  REQUIRED:
+                    name: user
+                create-file:
+                  filename: user.txt
+                  contents: "{{{{ REQUIRED.name }}}}"
+            anatomy-playbook:
+              use-features:
+                PROJECT:
+                  python: {python}
+                OPTIONAL: {{}}
+                USER: {{}}
+            target:
+              base.txt: |
+                {expected}
+              user.txt: |
+                user
+        """
+    )
+
+
 @pytest.fixture
 def anatomy_checker(datadir):
     class AnatomyChecker(object):
@@ -0,0 +1,12 @@
+def test_run_benchmarks():
+    """
+    Runs all benchmarks once on a tiny project, so API changes break the suite here instead of in the baselines.
+    """
+    from benchmarks.suite import BENCHMARKS, run_benchmarks
+    from benchmarks.synthetic import SyntheticProject
+
+    project = SyntheticProject(features=3, files=2, depth=2)
+    results = run_benchmarks(project, repeat=1)
+    assert sorted(results["results"]) == sorted(BENCHMARKS)
+    for i_result in results["results"].values():
+        assert i_result["min"] >= 0.0
@@ -0,0 +1,142 @@
+import sys
+import types
+
+import click
+import pytest
+from click.testing import CliRunner
+
+from zops.anatomy.assertions import assert_file_contents
+
+
+@pytest.fixture
+def cli(monkeypatch):
+    """
+    The anatomy cli module, imported with a stub zerotk.zops.Console.
+    """
+    import importlib
+
+    class Console(object):
+        @staticmethod
+        def info(*args):
+            click.echo(" ".join(str(i) for i in args))
+
+        error = title = info
+
+    zops_module = types.ModuleType("zerotk.zops")
+    zops_module.Console = Console
+    monkeypatch.setitem(sys.modules, "zerotk.zops", zops_module)
+    monkeypatch.delitem(sys.modules, "zops.anatomy.cli", raising=False)
+    return importlib.import_module("zops.anatomy.cli")
+
+
+@pytest.fixture
+def projects(datadir):
+    """
+    Creates the features file and the playbooks of the projects alpha and bravo.
+    """
+    datadir.join("anatomy-features/anatomy-features.yml").write(
+        "anatomy-features:\n"
+        "  - name: PROJECT\n"
+        "    variables:\n"
+        "      name: project\n"
+        "    create-file:\n"
+        "      filename: project.txt\n"
+        "      contents: This is {{ PROJECT.name }}.\n",
+        ensure=True,
+    )
+    for i_name in ("alpha", "bravo"):
+        datadir.join(i_name, "anatomy-playbook.yml").write(
+            "anatomy-playbook:\n"
+            "  use-features:\n"
+            "    PROJECT:\n"
+            f"      name: {i_name}\n",
+            ensure=True,
+        )
+    return datadir
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_apply_workers(cli, projects, workers):
+    directories = [str(projects.join(i)) for i in ("alpha", "bravo")]
+    result = CliRunner().invoke(
+        cli.main, ["apply", "--workers", str(workers)] + directories
+    )
+    assert result.exit_code == 0, result.output
+    for i_name in ("alpha", "bravo"):
+        assert_file_contents(
+            projects.join(i_name, "project.txt"), f"This is {i_name}.\n"
+        )
+        playbook_file = projects.join(i_name, "anatomy-playbook.yml")
+        assert f"Apply {playbook_file}" in result.output
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_apply_failures(cli, projects, workers):
+    """
+    The failed playbooks don't stop the others and are reported, with their tracebacks, in the exit code.
+    """
+    projects.join("bravo", "anatomy-playbook.yml").write(
+        "anatomy-playbook:\n  use-features:\n    UNKNOWN: {}\n"
+    )
+    directories = [str(projects.join(i)) for i in ("alpha", "bravo")]
+    result = CliRunner().invoke(
+        cli.main, ["apply", "--workers", str(workers)] + directories
+    )
+    assert result.exit_code == 1
+    assert_file_contents(projects.join("alpha", "project.txt"), "This is alpha.\n")
+    assert "Traceback (most recent call last):" in result.output
+    assert f"{projects.join('bravo')}: FeatureNotFound: 'UNKNOWN'" in result.output
+    assert "Failed to apply 1 of 2 playbooks." in result.output
+
+
+def test_apply_missing_playbook(cli, projects):
+    projects.join("charlie").ensure(dir=True)
+    directories = [str(projects.join(i)) for i in ("alpha", "charlie")]
+    result = CliRunner().invoke(cli.main, ["apply"] + directories)
+    assert result.exit_code == 1
+    assert_file_contents(projects.join("alpha", "project.txt"), "This is alpha.\n")
+    assert "CRITICAL: Playbook not found:" in result.output
+    assert "Failed to apply 1 of 2 playbooks." in result.output
+
+
+def test_apply_recursive(cli, projects):
+    """
+    Applies each playbook found under the directory in its own directory, except the git-ignored ones.
+    """
+    projects.join(".git").ensure(dir=True)
+    projects.join(".gitignore").write("bravo/\n")
+    result = CliRunner().invoke(cli.main, ["apply", "--recursive", str(projects)])
+    assert result.exit_code == 0, result.output
+    assert_file_contents(projects.join("alpha", "project.txt"), "This is alpha.\n")
+    assert not projects.join("bravo", "project.txt").exists()
+    assert not projects.join("project.txt").exists()
+
+    projects.join("alpha", "anatomy-playbook.yml").remove()
+    result = CliRunner().invoke(cli.main, ["apply", "-r", str(projects)])
+    assert result.exit_code == 1
+    assert "CRITICAL: No playbooks found in:" in result.output
+
+
+def test_apply_archive_stdout(cli, projects):
+    """
+    With the archive in stdout all messages go to stderr. The archive is discarded if any playbook fails.
+    """
+    import io
+    import tarfile
+
+    directories = [str(projects.join(i)) for i in ("alpha", "bravo")]
+    result = CliRunner().invoke(cli.main, ["apply", "--archive", "-"] + directories)
+    assert result.exit_code == 0, result.output
+    assert "Features filename:" in result.stderr
+    with tarfile.open(fileobj=io.BytesIO(result.stdout_bytes)) as iss:
+        assert iss.getnames() == ["alpha/project.txt", "bravo/project.txt"]
+        assert iss.getmember("alpha/project.txt").mtime > 0
+    assert not projects.join("alpha", "project.txt").exists()
+
+    projects.join("bravo", "anatomy-playbook.yml").write(
+        "anatomy-playbook:\n  use-features:\n    UNKNOWN: {}\n"
+    )
+    archive = str(projects.join("projects.tar"))
+    result = CliRunner().invoke(cli.main, ["apply", "--archive", archive] + directories)
+    assert result.exit_code == 1
+    assert not projects.join("projects.tar").exists()
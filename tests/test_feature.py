@@ -1,3 +1,5 @@
+import pytest
+
 from zops.anatomy.assertions import assert_file_contents
 from zops.anatomy.layers.feature import AnatomyFeature, AnatomyFeatureRegistry
 from zops.anatomy.layers.tree import AnatomyTree
@@ -107,3 +109,165 @@ def _play_feature(feature, directory, variables={}):
     feature.apply(tree)
     tree.apply(directory, variables)
     return tree
+
+
+def test_anatomy_feature_registry_instances(datadir):
+    from zops.anatomy.layers.playbook import AnatomyPlaybook
+
+    alpha = AnatomyFeatureRegistry()
+    alpha.register_from_text(
+        """
+            anatomy-features:
+              - name: PROJECT
+                create-file:
+                  filename: project.txt
+                  contents: This is alpha.
+        """
+    )
+    bravo = AnatomyFeatureRegistry()
+    bravo.register_from_text(
+        """
+            anatomy-features:
+              - name: PROJECT
+                create-file:
+                  filename: project.txt
+                  contents: This is bravo.
+        """
+    )
+    assert alpha.get("PROJECT") is not bravo.get("PROJECT")
+    assert AnatomyFeatureRegistry.default() is not alpha
+
+    for i_registry, i_name in ((alpha, "alpha"), (bravo, "bravo")):
+        playbook = AnatomyPlaybook.from_contents(
+            {"use-features": {"PROJECT": {}}}, registry=i_registry
+        )
+        playbook.apply(datadir + f"/{i_name}")
+        assert_file_contents(datadir + f"/{i_name}/project.txt", f"This is {i_name}.\n")
+
+
+def test_anatomy_feature_registry_from_file(datadir, monkeypatch):
+    import zerotk.lib.yaml
+    from zops.anatomy.layers import feature as feature_module
+
+    filename = datadir + "/anatomy-features.yml"
+    with open(filename, "w") as oss:
+        oss.write(
+            "anatomy-features:\n"
+            "  - name: ALPHA\n"
+            "    create-file:\n"
+            "      filename: alpha.txt\n"
+            "      contents: This is alpha.\n"
+        )
+    snapshot_dir = str(datadir + "/snapshots")
+
+    registry = AnatomyFeatureRegistry.from_file(filename, "templates", snapshot_dir)
+    assert registry.tree() == [("ALPHA", "alpha.txt", "alpha.txt")]
+    assert AnatomyFeatureRegistry.from_file(filename, "templates", snapshot_dir) is registry
+
+    # A new process loads the registry from the snapshot, without parsing the YAML file.
+    monkeypatch.setattr(feature_module, "_registries_by_file", {})
+    monkeypatch.setattr(zerotk.lib.yaml, "yaml_from_file", None)
+    registry = AnatomyFeatureRegistry.from_file(filename, "templates", snapshot_dir)
+    assert registry.tree() == [("ALPHA", "alpha.txt", "alpha.txt")]
+    assert registry.get("ANATOMY").name == "ANATOMY"
+
+
+def test_anatomy_feature_registry_closure():
+    from zops.anatomy.layers.feature import FeatureDependencyCycle
+
+    registry = AnatomyFeatureRegistry()
+    registry.register_from_text(
+        """
+            anatomy-features:
+              - name: BASE
+              - name: ALPHA
+                use-features:
+                  BASE: {}
+              - name: BRAVO
+                use-features:
+                  BASE: {}
+              - name: ZULU
+                use-features:
+                  ALPHA: {}
+                  BRAVO: {}
+        """
+    )
+    assert registry.closure("ZULU") == ("BASE", "ALPHA", "BRAVO", "ZULU")
+    assert list(registry.resolve(["BRAVO", "ZULU"])) == ["BASE", "BRAVO", "ALPHA", "ZULU"]
+
+    cycle = AnatomyFeatureRegistry()
+    cycle.register_from_text(
+        """
+            anatomy-features:
+              - name: CYCLE1
+                use-features:
+                  CYCLE2: {}
+              - name: CYCLE2
+                use-features:
+                  CYCLE1: {}
+        """
+    )
+    with pytest.raises(FeatureDependencyCycle, match="CYCLE1 -> CYCLE2 -> CYCLE1"):
+        cycle.closure("CYCLE1")
+
+
+def test_anatomy_feature_registry_indexes():
+    registry = AnatomyFeatureRegistry()
+    registry.register_from_text(
+        """
+            anatomy-features:
+              - name: ALPHA
+                create-files:
+                  - filename: setup.cfg
+                    contents: "[alpha]"
+                  - template: setup.py
+              - name: BRAVO
+                create-file:
+                  filename: setup.cfg
+                  template: setup.cfg
+        """
+    )
+    assert registry.file_features("setup.cfg") == ["ALPHA", "BRAVO"]
+    assert registry.file_features("setup.py") == ["ALPHA"]
+    assert registry.file_features("unknown.txt") == []
+    assert registry.feature_files("ALPHA") == ("setup.cfg", "setup.py")
+    assert registry.template_features("setup.cfg") == ["BRAVO"]
+    assert registry.tree() == [
+        ("ALPHA", "setup.cfg", "setup.cfg"),
+        ("ALPHA", "setup.py", "setup.py"),
+        ("BRAVO", "setup.cfg", "setup.cfg"),
+    ]
+
+
+def test_anatomy_feature_skip_features(datadir):
+    """
+    Skipping a feature in a playbook doesn't change the (shared) feature for the other playbooks.
+    """
+    from collections import OrderedDict
+
+    from zops.anatomy.layers.playbook import AnatomyPlaybook
+
+    registry = AnatomyFeatureRegistry()
+    registry.register_from_text(
+        """
+            anatomy-features:
+              - name: ALPHA
+                create-file:
+                  filename: alpha.txt
+                  contents: This is alpha.
+        """
+    )
+    skipping = AnatomyPlaybook.from_contents(
+        {"use-features": {"ALPHA": {}}, "skip-features": ["ALPHA"]}, registry=registry
+    )
+    using = AnatomyPlaybook.from_contents(
+        {"use-features": {"ALPHA": {}}}, registry=registry
+    )
+    skipping.apply(datadir + "/skipping")
+    using.apply(datadir + "/using")
+    assert not os.path.exists(datadir + "/skipping/alpha.txt")
+    assert_file_contents(datadir + "/using/alpha.txt", "This is alpha.\n")
+
+    # The registry is a keyword argument: the skipped features were a positional argument.
+    with pytest.raises(TypeError):
+        registry.get("ALPHA").using_features(OrderedDict(), ["ALPHA"])
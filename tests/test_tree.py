@@ -149,3 +149,788 @@ def test_merge_dict():
     assert merge_dict(
         {"PROJECT": {"code_name": "alpha"}}, {"PROJECT": {"code_name": "zulu"}}
     ) == {"PROJECT": {"code_name": "zulu"}}
+
+
+def test_template_engine_reuses_environment():
+    from zops.anatomy.layers.tree import TemplateEngine
+
+    engine = TemplateEngine.get()
+    assert engine is TemplateEngine.get()
+    assert engine.environment() is engine.environment()
+    assert engine.environment(alt_expansion=True) is not engine.environment()
+
+    # Variables are passed through the render context, so the filters see the values of each call.
+    assert engine.expand("{{ a|expandit }}", {"a": "{{ b }}", "b": "alpha"}) == "alpha"
+    assert engine.expand("{{ a|expandit }}", {"a": "{{ b }}", "b": "bravo"}) == "bravo"
+    assert engine.expand("{{{ a }}} {{ b }}", {"a": "alpha"}, alt_expansion=True) == "alpha {{ b }}"
+
+
+def test_template_cache():
+    from zops.anatomy.layers.tree import TemplateCache
+
+    cache = TemplateCache(maxsize=2)
+    assert cache.get("a", lambda: 1) == 1
+    assert cache.get("a", lambda: 2) == 1
+    assert cache.get("b", lambda: 3) == 3
+    assert cache.get("a", lambda: 4) == 1  # "a" is now the most recently used.
+    assert cache.get("c", lambda: 5) == 5  # Evicts "b".
+    assert cache.get("b", lambda: 6) == 6
+    assert cache.stats() == dict(hits=2, misses=4, size=2, maxsize=2)
+
+
+def test_template_engine_compiled_cache():
+    from zops.anatomy.layers.tree import TemplateEngine
+
+    engine = TemplateEngine()
+    assert engine.compile("{{ a }}") is engine.compile("{{ a }}")
+    assert engine.compile("{{ a }}") is not engine.compile("{{ a }}", alt_expansion=True)
+
+    assert engine.expand("{{ a }}", {"a": "alpha"}) == "alpha"
+    misses = engine.templates.misses
+    assert engine.expand("{{ a }}", {"a": "alpha"}) == "alpha"
+    assert engine.templates.misses == misses
+
+
+def test_template_engine_fixed_point():
+    from zops.anatomy.layers.tree import TemplateEngine, TemplateExpansionError
+
+    engine = TemplateEngine(max_iterations=5)
+
+    # Text without markers does not touch jinja2.
+    assert engine.expand("static text", {}) == "static text"
+    assert len(engine.templates) == 0
+
+    # Expansion stops as soon as the result has no markers.
+    assert engine.expand("{{ a }}", {"a": "{{ b }}", "b": "bravo"}) == "bravo"
+    assert len(engine.templates) == 2
+
+    # Self-referencing and oscillating variables are detected.
+    with pytest.raises(TemplateExpansionError):
+        engine.expand("{{ a }}", {"a": "{{ b }}", "b": "{{ a }}"})
+    with pytest.raises(TemplateExpansionError):
+        engine.expand("{{ a }}", {"a": "x{{ a }}"})
+
+
+def test_template_engine_filters_memo():
+    from zops.anatomy.layers.tree import TemplateEngine
+
+    class CountingEngine(TemplateEngine):
+        expansions = 0
+
+        def _expandit(self, text, *args, **kwargs):
+            self.expansions += 1
+            return super()._expandit(text, *args, **kwargs)
+
+    engine = CountingEngine()
+    text = (
+        "{% for i in items %}"
+        "{% if service|is_enabled %}{{ a|expandit }}{{ a|env_var }}{% endif %}"
+        "{% endfor %}"
+    )
+    variables = {
+        "items": list(range(100)),
+        "service": {"enabled": "{{ flag }}"},
+        "a": "{{ b }}",
+        "b": "x",
+        "flag": "yes",
+    }
+    assert engine.expand(text, variables) == "x${x}" * 100
+    # The top-level expansion plus one expansion of "a" for all filter calls.
+    assert engine.expansions == 2
+
+    # The memo lasts for a single expansion.
+    variables.update(b="y", flag="no")
+    assert engine.expand(text, variables) == ""
+    variables.update(flag="on")
+    assert engine.expand(text, variables) == "y${y}" * 100
+    assert list(engine.generate(text, variables)) == ["y", "${y}"] * 100
+
+
+def test_template_engine_bytecode_cache(datadir):
+    from zops.anatomy.layers.templates import AnatomyBytecodeCache
+    from zops.anatomy.layers.tree import TemplateEngine
+
+    with open(datadir + "/template.txt", "w") as oss:
+        oss.write("This is {{ name }}.")
+    cache_dir = str(datadir + "/cache")
+
+    engine = TemplateEngine()
+    engine.set_bytecode_cache(cache_dir)
+    result = engine.expand_template(datadir, "template.txt", {"name": "alpha"})
+    assert result == "This is alpha."
+    assert len(os.listdir(cache_dir)) == 1
+
+    # A new engine (a new process) loads the compiled template from the cache directory.
+    engine = TemplateEngine()
+    engine.set_bytecode_cache(AnatomyBytecodeCache(cache_dir))
+    result = engine.expand_template(datadir, "template.txt", {"name": "bravo"})
+    assert result == "This is bravo."
+    assert len(os.listdir(cache_dir)) == 1
+
+    assert engine.bytecode_cache.prune(max_age=3600) == 0
+    assert engine.bytecode_cache.prune(max_age=-1) == 1
+    assert os.listdir(cache_dir) == []
+
+
+def test_anatomy_file_from_template(datadir):
+    os.makedirs(datadir + "/templates/application")
+    template_filename = datadir + "/templates/application/setup.cfg"
+    with open(template_filename, "w") as oss:
+        oss.write("name = {{ PROJECT.name }}\n")
+
+    f = AnatomyFile("setup.cfg", "!setup.cfg")
+    variables = {
+        "ANATOMY": {"templates_dir": str(datadir + "/templates"), "template": "application"},
+        "PROJECT": {"name": "alpha"},
+    }
+
+    # The same file can be applied to many directories.
+    f.apply(datadir + "/alpha", variables)
+    variables["PROJECT"]["name"] = "bravo"
+    f.apply(datadir + "/bravo", variables)
+    assert_file_contents(datadir + "/alpha/setup.cfg", "name = alpha\n")
+    assert_file_contents(datadir + "/bravo/setup.cfg", "name = bravo\n")
+
+    # Changes on the template file are detected.
+    with open(template_filename, "w") as oss:
+        oss.write("project = {{ PROJECT.name }}\n")
+    os.utime(template_filename, ns=(0, 0))
+    f.apply(datadir + "/bravo", variables)
+    assert_file_contents(datadir + "/bravo/setup.cfg", "project = bravo\n")
+
+
+def test_anatomy_file_from_template_include(datadir):
+    os.makedirs(datadir + "/templates/application")
+    with open(datadir + "/templates/application/header.txt", "w") as oss:
+        oss.write("# {{ PROJECT.name }}\n")
+    with open(datadir + "/templates/application/macros.txt", "w") as oss:
+        oss.write("{% macro upper(text) %}{{ text|upper }}{% endmacro %}")
+    with open(datadir + "/templates/application/setup.cfg", "w") as oss:
+        oss.write(
+            '{% include "application/header.txt" %}'
+            '{% import "application/macros.txt" as macros %}'
+            "name = {{ macros.upper(PROJECT.name) }}\n"
+        )
+
+    f = AnatomyFile("setup.cfg", "!setup.cfg")
+    variables = {
+        "ANATOMY": {"templates_dir": str(datadir + "/templates"), "template": "application"},
+        "PROJECT": {"name": "alpha"},
+    }
+    f.apply(datadir + "/alpha", variables)
+    assert_file_contents(datadir + "/alpha/setup.cfg", "# alpha\nname = ALPHA\n")
+
+    # Templates are included from the templates directory of the including template.
+    os.makedirs(datadir + "/other/application")
+    with open(datadir + "/other/application/header.txt", "w") as oss:
+        oss.write("// {{ PROJECT.name }}\n")
+    with open(datadir + "/other/application/setup.cfg", "w") as oss:
+        oss.write('{% include "application/header.txt" %}')
+    variables["ANATOMY"]["templates_dir"] = str(datadir + "/other")
+    f.apply(datadir + "/other", variables)
+    assert_file_contents(datadir + "/other/setup.cfg", "// alpha\n")
+
+
+def test_anatomy_tree_write_if_changed(datadir):
+    from zops.anatomy.layers.tree import CREATED, UNCHANGED, WRITTEN
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is {{ name }}.")
+    tree.create_link("bravo.txt", "alpha.txt")
+    tree.add_variables({"name": "ALPHA"}, left_join=False)
+
+    assert tree.apply(datadir) == {CREATED: 2}
+    os.utime(datadir + "/alpha.txt", ns=(0, 0))
+
+    assert tree.apply(datadir) == {UNCHANGED: 2}
+    assert os.stat(datadir + "/alpha.txt").st_mtime_ns == 0
+
+    assert tree.apply(datadir, {"name": "BRAVO"}) == {WRITTEN: 1, UNCHANGED: 1}
+    assert_file_contents(datadir + "/bravo.txt", "This is BRAVO.\n")
+
+
+def test_anatomy_tree_plan(datadir):
+    from zops.anatomy.layers.tree import (
+        CREATED,
+        MODE_CHANGED,
+        MODIFIED,
+        RETARGETED,
+        UNCHANGED,
+    )
+
+    def plan(**kwargs):
+        return {
+            os.path.basename(i.filename): (i.status, i.diff)
+            for i in tree.plan(datadir, **kwargs)
+        }
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is {{ name }}.")
+    tree.create_file("charlie.sh", "echo charlie", executable=True)
+    tree.create_link("bravo.txt", "alpha.txt")
+    tree.add_variables({"name": "ALPHA"}, left_join=False)
+
+    assert plan() == {
+        "alpha.txt": (CREATED, None),
+        "bravo.txt": (CREATED, None),
+        "charlie.sh": (CREATED, None),
+    }
+    assert os.listdir(datadir) == []
+
+    tree.apply(datadir)
+    assert {i for i, _diff in plan().values()} == {UNCHANGED}
+
+    os.chmod(datadir + "/charlie.sh", 0o644)
+    os.unlink(datadir + "/bravo.txt")
+    os.symlink("charlie.sh", datadir + "/bravo.txt")
+    assert plan(variables={"name": "BRAVO"}, diff=True) == {
+        "alpha.txt": (
+            MODIFIED,
+            "--- {0}\n+++ {0}\n@@ -1 +1 @@\n-This is ALPHA.\n+This is BRAVO.\n".format(
+                datadir + "/alpha.txt"
+            ),
+        ),
+        "bravo.txt": (RETARGETED, None),
+        "charlie.sh": (MODE_CHANGED, None),
+    }
+    assert_file_contents(datadir + "/alpha.txt", "This is ALPHA.\n")
+
+
+def test_anatomy_tree_atomic(datadir, monkeypatch):
+    from zops.anatomy.layers.tree import CREATED, UNCHANGED, WRITTEN
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is {{ name }}.")
+    tree.create_file("sub/charlie.sh", "echo charlie", executable=True)
+    tree.create_link("bravo.txt", "alpha.txt")
+    tree.add_variables({"name": "ALPHA"}, left_join=False)
+
+    assert tree.apply(datadir, atomic=True, fsync=False) == {CREATED: 3}
+    assert_file_contents(datadir + "/alpha.txt", "This is ALPHA.\n")
+    assert os.readlink(datadir + "/bravo.txt") == "alpha.txt"
+    assert os.access(datadir + "/sub/charlie.sh", os.X_OK)
+    assert tree.apply(datadir, atomic=True) == {UNCHANGED: 3}
+
+    # A render error leaves the directory untouched.
+    tree.create_file("delta.txt", "{{ missing.value }}")
+    with pytest.raises(RuntimeError):
+        tree.apply(datadir, {"name": "BRAVO"}, atomic=True)
+    assert_file_contents(datadir + "/alpha.txt", "This is ALPHA.\n")
+    assert sorted(os.listdir(datadir)) == ["alpha.txt", "bravo.txt", "sub"]
+
+    # A failure while moving the files into place restores the replaced files.
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is {{ name }}.")
+    tree.create_file("echo/echo.txt", "This is echo.")
+    tree.add_variables({"name": "ALPHA"}, left_join=False)
+    replace = os.replace
+
+    def failing_replace(src, dst):
+        if dst.endswith("echo.txt"):
+            raise OSError("Failed")
+        replace(src, dst)
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "replace", failing_replace)
+        with pytest.raises(OSError):
+            tree.apply(datadir, {"name": "BRAVO"}, atomic=True)
+    assert_file_contents(datadir + "/alpha.txt", "This is ALPHA.\n")
+    assert sorted(os.listdir(datadir)) == ["alpha.txt", "bravo.txt", "sub"]
+
+    assert tree.apply(datadir, {"name": "BRAVO"}, atomic=True) == {
+        WRITTEN: 1,
+        CREATED: 1,
+    }
+    assert_file_contents(datadir + "/alpha.txt", "This is BRAVO.\n")
+
+
+@pytest.mark.parametrize("atomic", [False, True])
+@pytest.mark.parametrize("streaming", [False, True])
+def test_anatomy_tree_symlinked_file(datadir, atomic, streaming):
+    """
+    Files are written through existing symlinks, with or without atomic.
+    """
+    from zops.anatomy.layers.sinks import UMASK
+    from zops.anatomy.layers.tree import CREATED, MODIFIED, UNCHANGED, WRITTEN
+
+    os.makedirs(datadir + "/shared")
+    os.symlink("shared/alpha.txt", datadir + "/alpha.txt")
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is {{ name }}.")
+    tree.add_variables({"name": "ALPHA"}, left_join=False)
+    stats = tree.apply(datadir, atomic=atomic, streaming=streaming)
+    assert stats == {CREATED: 1}
+    assert os.readlink(datadir + "/alpha.txt") == "shared/alpha.txt"
+    assert_file_contents(datadir + "/shared/alpha.txt", "This is ALPHA.\n")
+    assert os.stat(datadir + "/shared/alpha.txt").st_mode & 0o777 == 0o666 & ~UMASK
+
+    # Plan compares the symlink target, like apply.
+    entries = tree.plan(datadir, diff=True)
+    assert [(i.filename, i.status) for i in entries] == [
+        (datadir + "/alpha.txt", UNCHANGED)
+    ]
+    (entry,) = tree.plan(datadir, {"name": "BRAVO"}, diff=True)
+    assert entry.status == MODIFIED
+    assert "+This is BRAVO." in entry.diff
+
+    stats = tree.apply(datadir, {"name": "BRAVO"}, atomic=atomic, streaming=streaming)
+    assert stats == {WRITTEN: 1}
+    assert os.readlink(datadir + "/alpha.txt") == "shared/alpha.txt"
+    assert_file_contents(datadir + "/shared/alpha.txt", "This is BRAVO.\n")
+
+
+@pytest.mark.skipif(
+    not os.path.exists("/proc/self/status"), reason="Reads the umask from /proc."
+)
+def test_read_umask(monkeypatch):
+    from zops.anatomy.layers import sinks
+
+    # Changing the umask, even to read it, races with the threads creating files.
+    def fail(mask):
+        raise AssertionError("Should not change the umask.")
+
+    monkeypatch.setattr(os, "umask", fail)
+    assert sinks._read_umask() == sinks.UMASK
+
+
+def test_anatomy_tree_memory_sink(datadir):
+    from zops.anatomy.layers.sinks import AnatomyMemoryEntry, AnatomyMemorySink
+    from zops.anatomy.layers.tree import CREATED, UNCHANGED, WRITTEN
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is {{ name }}.")
+    tree.create_file("sub/charlie.sh", "echo charlie", executable=True)
+    tree.create_link("bravo.txt", "alpha.txt")
+    tree.add_variables({"name": "ALPHA"}, left_join=False)
+
+    sink = AnatomyMemorySink(root=datadir)
+    assert tree.apply(datadir, sink=sink) == {CREATED: 3}
+    assert os.listdir(datadir) == []
+    assert sink.files == {
+        "alpha.txt": AnatomyMemoryEntry(b"This is ALPHA.\n", 0o644),
+        "bravo.txt": AnatomyMemoryEntry(mode=0o777, target="alpha.txt"),
+        "sub/charlie.sh": AnatomyMemoryEntry(b"echo charlie\n", 0o755),
+    }
+
+    assert tree.apply(datadir, {"name": "BRAVO"}, sink=sink) == {
+        WRITTEN: 1,
+        UNCHANGED: 2,
+    }
+    assert sink.files["alpha.txt"].contents == b"This is BRAVO.\n"
+
+    with pytest.raises(ValueError):
+        tree.apply(datadir, sink=sink, incremental=True)
+
+
+@pytest.mark.parametrize("format_", ["tar.gz", "zip"])
+def test_anatomy_tree_archive_sink(datadir, format_):
+    import tarfile
+    import zipfile
+
+    from zops.anatomy.layers.sinks import AnatomyArchiveSink
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is alpha.")
+    tree.create_file("sub/charlie.sh", "echo charlie", executable=True)
+    tree.create_link("bravo.txt", "alpha.txt")
+
+    archive = datadir + f"/project.{format_}"
+    with AnatomyArchiveSink(archive) as sink:
+        tree.apply("project", sink=sink)
+
+    if format_ == "zip":
+        with zipfile.ZipFile(archive) as iss:
+            assert iss.namelist() == [
+                "project/alpha.txt",
+                "project/sub/charlie.sh",
+                "project/bravo.txt",
+            ]
+            assert iss.read("project/alpha.txt") == b"This is alpha.\n"
+            info = iss.getinfo("project/sub/charlie.sh")
+            assert info.external_attr >> 16 & 0o777 == 0o755
+    else:
+        with tarfile.open(archive) as iss:
+            assert iss.getnames() == [
+                "project/alpha.txt",
+                "project/sub/charlie.sh",
+                "project/bravo.txt",
+            ]
+            assert iss.extractfile("project/alpha.txt").read() == b"This is alpha.\n"
+            assert iss.getmember("project/sub/charlie.sh").mode == 0o755
+            assert iss.getmember("project/bravo.txt").linkname == "alpha.txt"
+
+
+@pytest.mark.parametrize("format_", ["tar", "tar.gz", "zip"])
+def test_anatomy_tree_archive_sink_abort(datadir, format_):
+    import io
+    import tarfile
+    import time
+    import zipfile
+
+    from zops.anatomy.layers.sinks import AnatomyArchiveSink
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is alpha.")
+    tree.create_file("bravo.txt", "{{ missing.value }}")
+
+    # The archive file is removed.
+    archive = datadir + f"/project.{format_}"
+    with pytest.raises(RuntimeError):
+        with AnatomyArchiveSink(archive) as sink:
+            tree.apply("project", sink=sink)
+    assert not os.path.exists(archive)
+
+    # A file object is left without the end of the archive.
+    oss = io.BytesIO()
+    with pytest.raises(RuntimeError):
+        with AnatomyArchiveSink(oss, format_) as sink:
+            tree.apply("project", sink=sink)
+    oss.seek(0)
+    if format_ == "zip":
+        with pytest.raises(zipfile.BadZipFile):
+            zipfile.ZipFile(oss)
+    else:
+        with pytest.raises(tarfile.ReadError):
+            tarfile.open(fileobj=oss).getmembers()
+
+    # The members have the archive creation time.
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is alpha.")
+    oss = io.BytesIO()
+    with AnatomyArchiveSink(oss, format_) as sink:
+        tree.apply("project", sink=sink)
+    oss.seek(0)
+    if format_ == "zip":
+        mtime = time.mktime(zipfile.ZipFile(oss).infolist()[0].date_time + (0, 0, -1))
+    else:
+        mtime = tarfile.open(fileobj=oss).getmembers()[0].mtime
+    assert abs(mtime - sink.mtime) <= 2
+
+
+def test_anatomy_tree_iter_render(datadir):
+    from zops.anatomy.layers.tree import AnatomyRecord
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is {{ name }}. \n\n")
+    tree.create_link("bravo.txt", "alpha.txt")
+    tree.create_file("sub/charlie.sh", "echo charlie", executable=True)
+    tree.add_variables({"name": "ALPHA"}, left_join=False)
+
+    assert list(tree.iter_render(datadir)) == [
+        AnatomyRecord(datadir + "/alpha.txt", "This is ALPHA.\n", False, None),
+        AnatomyRecord(datadir + "/sub/charlie.sh", "echo charlie\n", True, None),
+        AnatomyRecord(datadir + "/bravo.txt", None, False, "alpha.txt"),
+    ]
+    assert os.listdir(datadir) == []
+
+    # Files are rendered lazily: the first one is available before the second fails.
+    tree.create_file("delta.txt", "{{ missing.value }}")
+    records = tree.iter_render(datadir)
+    assert next(records).path == datadir + "/alpha.txt"
+    next(records)
+    with pytest.raises(RuntimeError):
+        next(records)
+
+
+def test_template_engine_generate():
+    from zops.anatomy.layers.tree import MultiPassTemplate, TemplateEngine
+
+    engine = TemplateEngine()
+    text = "{% for i in items %}{{ i }} \n{% endfor %}"
+    chunks = list(engine.generate(text, {"items": range(3)}))
+    assert len(chunks) > 1
+    assert "".join(chunks) == engine.expand(text, {"items": range(3)})
+
+    with pytest.raises(MultiPassTemplate):
+        list(engine.generate("{{ a }}", {"a": "{{ b }}", "b": "bravo"}))
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        ["alpha \n", "bravo  \n\n"],
+        ["alpha ", "\nbravo ", " \n", "\n", " "],
+        ["\n\n", "", "\n"],
+        [],
+    ],
+)
+def test_anatomy_file_normalize_chunks(chunks):
+    assert b"".join(AnatomyFile._normalize_chunks(chunks)) == AnatomyFile._normalize(
+        "".join(chunks)
+    )
+
+
+def test_anatomy_tree_streaming(datadir):
+    from zops.anatomy.layers.tree import CREATED, UNCHANGED
+
+    tree = AnatomyTree()
+    tree.create_file(
+        "alpha.txt", "{% for i in range(1000) %}line {{ i }} \n{% endfor %}"
+    )
+    tree.create_file("bravo.txt", "This is {{ name }}.")
+    tree.create_file("charlie.sh", "echo charlie", executable=True)
+    tree.add_variables({"name": "{{ 'BRAVO' | lower }}"}, left_join=False)
+
+    assert tree.apply(datadir, streaming=True) == {CREATED: 3}
+    expected = "".join(f"line {i}\n" for i in range(1000))
+    assert_file_contents(datadir + "/alpha.txt", expected)
+    assert_file_contents(datadir + "/bravo.txt", "This is bravo.\n")
+    assert os.access(datadir + "/charlie.sh", os.X_OK)
+    assert sorted(os.listdir(datadir)) == ["alpha.txt", "bravo.txt", "charlie.sh"]
+
+    assert tree.apply(datadir, streaming=True) == {UNCHANGED: 3}
+    assert tree.apply(datadir, streaming=True, atomic=True) == {UNCHANGED: 3}
+    os.unlink(datadir + "/alpha.txt")
+    assert tree.apply(datadir, streaming=True, atomic=True) == {
+        CREATED: 1,
+        UNCHANGED: 2,
+    }
+    assert_file_contents(datadir + "/alpha.txt", expected)
+
+
+def _rendered(profile):
+    """
+    Returns the names of the files rendered, recorded in the given AnatomyProfile: the skipped files have no stats.
+    """
+    return sorted(os.path.basename(i) for i in profile.to_dict()["files"])
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_anatomy_tree_incremental(datadir, monkeypatch, streaming):
+    from zops.anatomy.layers.profile import AnatomyProfile
+    from zops.anatomy.layers.tree import UNCHANGED, WRITTEN
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is {{ alpha }}.")
+    tree.create_file("bravo.txt", "This is bravo.")
+    tree.add_variables({"alpha": "ALPHA"}, left_join=False)
+
+    def apply(variables=None):
+        tree.profile = AnatomyProfile()
+        return tree.apply(datadir, variables, incremental=True, streaming=streaming)
+
+    apply()
+    assert _rendered(tree.profile) == ["alpha.txt", "bravo.txt"]
+    assert os.path.isfile(datadir + "/.anatomy-manifest.json")
+
+    # Files with the same fingerprint are not rendered again.
+    def fail(*args, **kwargs):
+        raise AssertionError("Should not render.")
+
+    with monkeypatch.context() as m:
+        m.setattr(AnatomyFile, "render", fail)
+        m.setattr(AnatomyFile, "stream", fail)
+        assert apply() == {UNCHANGED: 2}
+
+    # Files changed on disk are created again.
+    with open(datadir + "/bravo.txt", "w") as oss:
+        oss.write("Changed.\n")
+    assert apply() == {UNCHANGED: 1, WRITTEN: 1}
+    assert _rendered(tree.profile) == ["bravo.txt"]
+    assert_file_contents(datadir + "/bravo.txt", "This is bravo.\n")
+
+    assert apply({"alpha": "ZULU"}) == {UNCHANGED: 1, WRITTEN: 1}
+    assert _rendered(tree.profile) == ["alpha.txt"]
+    assert_file_contents(datadir + "/alpha.txt", "This is ZULU.\n")
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_anatomy_tree_incremental_multiple_passes(datadir, monkeypatch, streaming):
+    """
+    The variables read by template syntax created by the expansion itself are found while rendering.
+    """
+    from zops.anatomy.layers.profile import AnatomyProfile
+    from zops.anatomy.layers.tree import CREATED, UNCHANGED, WRITTEN
+
+    os.makedirs(datadir + "/templates/application")
+    with open(datadir + "/templates/application/header.txt", "w") as oss:
+        oss.write("# {{ PROJECT.title }}\n")
+    with open(datadir + "/templates/application/charlie.txt", "w") as oss:
+        oss.write('{% include "application/header.txt" %}')
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "{{ 'PROJECT.name' | dmustache }}")
+    tree.create_file("bravo.txt", "{{ ('{{ PROJECT.' ~ 'code }}') | expandit }}")
+    tree.create_file("charlie.txt", "!charlie.txt")
+    tree.add_variables(
+        {
+            "ANATOMY": {
+                "templates_dir": str(datadir + "/templates"),
+                "template": "application",
+            },
+            "PROJECT": {"name": "alpha", "code": "a", "title": "Alpha"},
+        },
+        left_join=False,
+    )
+    target_dir = datadir + "/target"
+
+    def apply(variables=None):
+        tree.profile = AnatomyProfile()
+        return tree.apply(
+            target_dir, variables, incremental=True, streaming=streaming
+        )
+
+    assert apply() == {CREATED: 3}
+    assert _rendered(tree.profile) == ["alpha.txt", "bravo.txt", "charlie.txt"]
+
+    # Only the file including templates is rendered again (see AnatomyFile.fingerprint).
+    def fail(*args, **kwargs):
+        raise AssertionError("Should not render.")
+
+    with monkeypatch.context() as m:
+        m.setattr(AnatomyFile, "render", fail)
+        m.setattr(AnatomyFile, "stream", fail)
+        with pytest.raises(AssertionError, match="Should not render."):
+            apply()
+    assert apply() == {UNCHANGED: 3}
+    assert _rendered(tree.profile) == ["charlie.txt"]
+
+    # Only the variables read by later passes changed.
+    variables = {"PROJECT": {"name": "alpha", "code": "b", "title": "Alpha"}}
+    assert apply(variables) == {WRITTEN: 1, UNCHANGED: 2}
+    assert _rendered(tree.profile) == ["bravo.txt", "charlie.txt"]
+
+    variables = {"PROJECT": {"name": "bravo", "code": "b", "title": "Bravo"}}
+    assert apply(variables) == {WRITTEN: 2, UNCHANGED: 1}
+    assert _rendered(tree.profile) == ["alpha.txt", "charlie.txt"]
+    assert_file_contents(target_dir + "/alpha.txt", "bravo\n")
+    assert_file_contents(target_dir + "/bravo.txt", "b\n")
+    assert_file_contents(target_dir + "/charlie.txt", "# Bravo\n")
+
+
+def test_anatomy_file_dependencies():
+    f = AnatomyFile(
+        "{{ PROJECT.name }}.txt",
+        """
+            {{ DJANGO.version }} {{ SERVICES['db'].port }}
+            {% for i in PROJECT.items() %}{{ i }}{% endfor %}
+            {{ DJANGO.settings|expandit }}
+        """,
+    )
+    variables = {
+        "PROJECT": {"name": "alpha"},
+        "DJANGO": {"version": "5.0", "settings": "DEBUG={{ DEBUG.enabled }}"},
+        "SERVICES": {"db": {"port": 5432}},
+        "DEBUG": {"enabled": "true"},
+        "UNUSED": {"name": "zulu"},
+    }
+    assert f.dependencies(variables) == {
+        "PROJECT.name",
+        "PROJECT",
+        "DJANGO.version",
+        "DJANGO.settings",
+        "DEBUG.enabled",
+        "SERVICES.db.port",
+    }
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "{{ DJANGO.version }}")
+    tree.create_file("bravo.txt", "{{ DJANGO }}")
+    tree.create_file("charlie.txt", "{{ PROJECT.name }}")
+    tree.add_variables(variables, left_join=False)
+    assert tree.affected_files("DJANGO.version") == ["alpha.txt", "bravo.txt"]
+    assert tree.affected_files("DJANGO") == ["alpha.txt", "bravo.txt"]
+    assert tree.affected_files("UNUSED.name") == []
+
+
+def test_anatomy_tree_jobs(datadir):
+    from zops.anatomy.layers.tree import CREATED
+
+    tree = AnatomyTree()
+    for i in range(10):
+        tree.create_file(f"file{i}.txt", "This is {{ name }} %d." % i)
+    tree.create_link("link.txt", "file9.txt")
+    tree.add_variables({"name": "ALPHA"}, left_join=False)
+
+    assert tree.apply(datadir, jobs=3) == {CREATED: 11}
+    for i in range(10):
+        assert_file_contents(datadir + f"/file{i}.txt", f"This is ALPHA {i}.\n")
+    assert_file_contents(datadir + "/link.txt", "This is ALPHA 9.\n")
+
+    # The error reported is always the one from the first failing file.
+    tree.create_file("error1.txt", "{{ undefined1 }}")
+    tree.create_file("error2.txt", "{{ undefined2 }}")
+    with pytest.raises(RuntimeError, match="error1.txt"):
+        tree.apply(datadir, jobs=3)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_anatomy_tree_profile(datadir, jobs):
+    from zops.anatomy.layers.profile import AnatomyProfile
+
+    tree = AnatomyTree()
+    tree.create_file("alpha.txt", "This is {{ name }}.")
+    tree.create_file("bravo.txt", "This is {{ nested }}.")
+    tree.create_link("charlie.txt", "alpha.txt")
+    tree.add_variables({"name": "ALPHA", "nested": "{{ name }}"}, left_join=False)
+
+    tree.profile = AnatomyProfile()
+    tree.apply(datadir, jobs=jobs)
+    assert_file_contents(datadir + "/bravo.txt", "This is ALPHA.\n")
+
+    profile = tree.profile.to_dict()
+    assert {"variables", "filename", "render", "write"} <= set(profile["phases"])
+    assert profile["phases"]["render"]["count"] == 2
+    files = profile["files"]
+    assert files[datadir + "/alpha.txt"]["iterations"] == 1
+    assert files[datadir + "/bravo.txt"]["iterations"] == 2
+    assert files[datadir + "/bravo.txt"]["fileid"] == "bravo.txt"
+    templates = sorted(i["template"] for i in profile["templates"])
+    assert templates == ["alpha.txt", "bravo.txt"]
+    assert profile["total"] > 0.0
+
+
+def test_anatomy_variables():
+    from zops.anatomy.layers.tree import AnatomyVariables
+
+    layers = [
+        ({"PROJECT": {"name": "alpha", "tags": ["a"]}, "ANATOMY": {}}, False),
+        ({"PROJECT": {"name": "bravo", "tags": ["b"]}}, True),
+        ({"PROJECT": {"deep": {"x": 1}}, "DJANGO": {"version": "4"}}, False),
+        ({"PROJECT": {"deep": {"y": 2}}, "DJANGO!": {"debug": True}}, True),
+        ({"PROJECT": {"tags!": ["c"], "deep": None}}, True),
+    ]
+    expected = {}
+    variables = AnatomyVariables()
+    for i_layer, i_left_join in layers:
+        expected = merge_dict(expected, i_layer, left_join=i_left_join)
+        variables.add(i_layer, left_join=i_left_join)
+        assert variables == expected
+
+    # Layers are not modified by the merge.
+    assert layers[0][0]["PROJECT"]["tags"] == ["a"]
+
+    # Same validation as merge_dict.
+    with pytest.raises(RuntimeError):
+        variables.add({"UNKNOWN": {}})
+    with pytest.raises(RuntimeError):
+        variables.add({"PROJECT": {"unknown": 1}})
+
+    chained = variables.chain({"PROJECT": {"name": "charlie"}})
+    assert chained["PROJECT"]["name"] == "charlie"
+    assert variables["PROJECT"]["name"] == "bravo"
+
+
+def test_strtobool():
+    from zops.anatomy.layers.tree import strtobool
+
+    assert strtobool("Yes") is True
+    assert strtobool("on") is True
+    assert strtobool("False") is False
+    assert strtobool("0") is False
+    with pytest.raises(ValueError):
+        strtobool("maybe")
+
+
+def test_import_is_lazy():
+    import subprocess
+    import sys
+
+    code = (
+        "import sys, zops.anatomy.layers.playbook;"
+        "print(' '.join(sorted(sys.modules)))"
+    )
+    modules = subprocess.check_output([sys.executable, "-c", code], text=True).split()
+    for i_module in ("distutils", "pkg_resources", "jinja2", "stringcase"):
+        assert i_module not in modules
@@ -1,4 +1,2 @@
-try:
-    __import__("pkg_resources").declare_namespace(__name__)
-except ImportError:
-    __path__ = __import__("pkgutil").extend_path(__path__, __name__)
+# pkgutil-style namespace package: declaring it through pkg_resources costs more than importing all of zops.anatomy.
+__path__ = __import__("pkgutil").extend_path(__path__, __name__)
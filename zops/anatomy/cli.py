@@ -1,4 +1,5 @@
 import os
+from dataclasses import dataclass
 from os.path import dirname
 from zerotk.zops import Console
 
@@ -17,14 +18,169 @@ def main():
 @click.argument("directories", nargs=-1)
 @click.option("--features-file", default=None, envvar="ZOPS_ANATOMY_FEATURES")
 @click.option("--templates-dir", default=None, envvar="ZOPS_ANATOMY_TEMPLATES")
+@click.option("--cache-dir", default=None, envvar="ZOPS_ANATOMY_CACHE_DIR")
 @click.option("--playbook-file", default=None)
 @click.option("--recursive", "-r", is_flag=True)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Skip files that didn't change since the last apply (keeps .anatomy-manifest.json).",
+)
+@click.option(
+    "--plan",
+    is_flag=True,
+    help="Report the files apply would change, without writing anything.",
+)
+@click.option("--diff", is_flag=True, help="With --plan, show a diff of each change.")
+@click.option(
+    "--atomic",
+    is_flag=True,
+    help="Render all files before writing and write them all or none.",
+)
+@click.option(
+    "--no-fsync",
+    "fsync",
+    flag_value=False,
+    default=True,
+    help="With --atomic, don't sync the files to disk (faster, for throwaway checkouts).",
+)
+@click.option(
+    "--archive",
+    default=None,
+    help="Write the files into this tar or zip archive instead of the directories ('-' for a tar in stdout).",
+)
+@click.option(
+    "--streaming",
+    is_flag=True,
+    help="Write large files chunk by chunk as they're rendered (ignores --jobs).",
+)
+@click.option(
+    "--profile",
+    "profile_file",
+    default=None,
+    help="Save the apply timings (per phase, feature, file and template) in this JSON file.",
+)
+@click.option(
+    "--profile-top",
+    default=10,
+    help="Number of slowest templates reported by --profile.",
+)
+@click.option(
+    "--jobs", "-j", default=1, help="Number of processes used to render the files."
+)
+@click.option(
+    "--workers",
+    "-w",
+    default=1,
+    help="Number of processes used to apply the directories concurrently.",
+)
 @click.pass_context
-def apply(ctx, directories, features_file, templates_dir, playbook_file, recursive):
+def apply(
+    ctx,
+    directories,
+    features_file,
+    templates_dir,
+    cache_dir,
+    playbook_file,
+    recursive,
+    incremental,
+    plan,
+    diff,
+    atomic,
+    fsync,
+    archive,
+    streaming,
+    profile_file,
+    profile_top,
+    jobs,
+    workers,
+):
     """
     Apply templates.
+
+    With --recursive, applies each anatomy-playbook.yml found under the directories (except the git-ignored ones) in
+    its own directory.
+    """
+    import contextlib
+    import sys
+
+    # All messages go to stderr when the archive is written to stdout.
+    if archive == "-":
+        archive = sys.stdout.buffer
+        ctx.with_resource(contextlib.redirect_stdout(sys.stderr))
+
+    tasks = []
+    missing = 0
+    for i_directory, i_filename in _find_playbooks(
+        directories, playbook_file, recursive
+    ):
+        if i_filename is None:
+            missing += 1
+            continue
+        i_features_file = features_file or _find_features_file(dirname(i_filename))
+        i_templates_dir = templates_dir or os.path.join(
+            os.path.dirname(i_features_file), "templates"
+        )
+        tasks.append(
+            _ApplyTask(
+                directory=i_directory,
+                playbook_file=i_filename,
+                features_file=i_features_file,
+                templates_dir=i_templates_dir,
+                cache_dir=cache_dir,
+                incremental=incremental,
+                plan=plan,
+                diff=diff,
+                atomic=atomic,
+                fsync=fsync,
+                streaming=streaming,
+                profile_top=profile_top if profile_file else None,
+                jobs=jobs,
+            )
+        )
+
+    failures = missing
+    profiles = {}
+    if archive is not None:
+        results = _apply_to_archive(tasks, archive)
+    elif workers > 1 and len(tasks) > 1:
+        results = _apply_concurrently(tasks, workers)
+    else:
+        results = (_apply_task(i) for i in tasks)
+
+    for i_task, (i_stats, i_output, i_error, i_profile) in zip(tasks, results):
+        if i_output:
+            click.echo(i_output, nl=False)
+        if i_profile is not None:
+            profiles[i_task.directory] = i_profile
+        if i_error is None:
+            Console.info(f"{i_task.directory}: {_format_stats(i_stats)}")
+        else:
+            Console.error(f"{i_task.directory}: {i_error}")
+            failures += 1
+
+    if profile_file is not None:
+        import json
+
+        with open(profile_file, "w") as oss:
+            json.dump(profiles, oss, indent=1, sort_keys=True)
+
+    if failures:
+        total = len(tasks) + missing
+        Console.error(f"Failed to apply {failures} of {total} playbooks.")
+        ctx.exit(1)
+
+
+def _find_playbooks(directories, playbook_file, recursive):
+    """
+    Finds the playbooks to apply in the given directories: the given playbook file, the project playbook
+    (anatomy-features/playbooks/<directory name>.yml, in any parent directory) or the directory anatomy-playbook.yml.
+    With recursive, a directory without these playbooks is searched for anatomy-playbook.yml files.
+
+    :return iter(2-tuple(str, str)):
+        Yields the directory where each playbook is applied and the playbook filename, or None if no playbook was
+        found for the directory (the error is reported).
     """
-    from .layers.playbook import AnatomyPlaybook
     from zerotk.lib.path import find_up
 
     for i_directory in directories:
@@ -33,31 +189,251 @@ def apply(ctx, directories, features_file, templates_dir, playbook_file, recursi
         try:
             project_playbook_filename = find_up(project_playbook_filename, i_directory)
         except FileNotFoundError:
-            click.echo(f"CRITICAL: Playbook not found: {project_playbook_filename}")
-            continue
+            project_playbook_filename = None
+        directory_playbook_filename = os.path.join(i_directory, "anatomy-playbook.yml")
 
         if playbook_file is not None:
-            playbook_filenames = [playbook_file]
-        elif os.path.exists(project_playbook_filename):
-            playbook_filenames = [project_playbook_filename]
+            yield i_directory, playbook_file
+        elif project_playbook_filename is not None:
+            yield i_directory, project_playbook_filename
+        elif os.path.exists(directory_playbook_filename):
+            yield i_directory, directory_playbook_filename
         elif recursive:
-            directory = os.path.abspath(i_directory)
-            playbook_filenames = find_all("anatomy-playbook.yml", directory)
-            playbook_filenames = GitIgnored().filter(playbook_filenames)
+            from zerotk.lib.gitignored import GitIgnored
+            from zerotk.lib.path import find_all
+
+            filenames = find_all("anatomy-playbook.yml", os.path.abspath(i_directory))
+            filenames = sorted(str(i) for i in GitIgnored().filter(filenames))
+            if not filenames:
+                click.echo(f"CRITICAL: No playbooks found in: {i_directory}")
+                yield i_directory, None
+            for j_filename in filenames:
+                yield os.path.dirname(j_filename), j_filename
         else:
-            playbook_filenames = [i_directory + "/anatomy-playbook.yml"]
+            click.echo(f"CRITICAL: Playbook not found: {directory_playbook_filename}")
+            yield i_directory, None
 
-        for i_filename in playbook_filenames:
-            features_file = features_file or _find_features_file(dirname(i_filename))
-            templates_dir = templates_dir or os.path.join(
-                os.path.dirname(features_file), "templates"
-            )
-            Console.info(f"Apply {i_filename}")
-            _register_features(features_file, templates_dir)
 
-            Console.title(i_directory)
-            anatomy_playbook = AnatomyPlaybook.from_file(i_filename)
-            anatomy_playbook.apply(i_directory)
+@dataclass
+class _ApplyTask:
+    directory: str
+    playbook_file: str
+    features_file: str
+    templates_dir: str
+    cache_dir: str
+    incremental: bool
+    plan: bool
+    diff: bool
+    atomic: bool
+    fsync: bool
+    streaming: bool
+    profile_top: int
+    jobs: int
+
+
+def _apply_task(task, capture_output=False, sink=None):
+    """
+    Applies a playbook in a directory.
+
+    :param _ApplyTask task:
+    :param bool capture_output:
+        If True, captures the standard output, returning it instead of printing it.
+    :param AnatomySink sink:
+        See AnatomyPlaybook.apply.
+    :return 4-tuple(Counter, str, str, dict):
+        Returns the stats (see AnatomyTree.apply), the captured output, the error message, if any, and the profile
+        (see AnatomyProfile.to_dict), if task.profile_top is set. In plan mode the stats count the planned changes
+        (see AnatomyTree.plan).
+    """
+    import contextlib
+    import io
+    import sys
+
+    from .layers.playbook import AnatomyPlaybook
+    from .layers.profile import NULL_PROFILE, AnatomyProfile
+
+    output = io.StringIO()
+    if capture_output:
+        redirect = contextlib.redirect_stdout(output)
+    else:
+        redirect = contextlib.nullcontext()
+
+    stats = None
+    error = None
+    profile = NULL_PROFILE if task.profile_top is None else AnatomyProfile()
+    with redirect:
+        try:
+            if task.cache_dir is not None:
+                _set_bytecode_cache(task.cache_dir)
+            Console.info(f"Apply {task.playbook_file}")
+            with profile.measure("registry"):
+                registry = _register_features(
+                    task.features_file, task.templates_dir, task.cache_dir
+                )
+
+            Console.title(task.directory)
+            with profile.measure("features"):
+                anatomy_playbook = AnatomyPlaybook.from_file(
+                    task.playbook_file, registry=registry
+                )
+            if task.plan:
+                stats = _print_plan(
+                    anatomy_playbook.plan(
+                        task.directory, diff=task.diff, jobs=task.jobs
+                    )
+                )
+            else:
+                stats = anatomy_playbook.apply(
+                    task.directory,
+                    incremental=task.incremental,
+                    jobs=task.jobs,
+                    atomic=task.atomic,
+                    fsync=task.fsync,
+                    sink=sink,
+                    streaming=task.streaming,
+                    profile=profile or None,
+                )
+        except Exception as e:
+            import traceback
+
+            # The traceback goes with the task output: captured when the tasks run concurrently.
+            traceback.print_exc(file=sys.stdout)
+            error = "{}: {}".format(e.__class__.__name__, e)
+    if profile:
+        profile = profile.to_dict(task.profile_top)
+    else:
+        profile = None
+    return stats, output.getvalue(), error, profile
+
+
+def _apply_concurrently(tasks, workers):
+    """
+    Applies the tasks in a process pool. Each task registers its own features.
+
+    :return list(4-tuple):
+        The results of _apply_task, in the same order of the tasks.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(partial(_apply_task, capture_output=True), tasks))
+
+
+def _apply_to_archive(tasks, archive):
+    """
+    Applies the tasks, in order, writing all files in the same archive. The archive names start with the name of
+    each task directory. The archive is discarded (see AnatomyArchiveSink.abort) if any task fails.
+
+    :param str|file archive:
+        The archive filename or binary file object.
+    :return list(4-tuple):
+        See _apply_concurrently.
+    """
+    from .layers.sinks import AnatomyArchiveSink
+
+    result = []
+    sink = AnatomyArchiveSink(archive)
+    try:
+        for i_task in tasks:
+            sink.root = os.path.dirname(os.path.abspath(i_task.directory))
+            result.append(_apply_task(i_task, sink=sink))
+    except BaseException:
+        sink.abort()
+        raise
+    if any(i_error is not None for _stats, _output, i_error, _profile in result):
+        sink.abort()
+    else:
+        sink.close()
+    return result
+
+
+def _print_plan(entries):
+    """
+    Prints the planned changes.
+
+    :param list(AnatomyPlanEntry) entries:
+    :return Counter:
+        Returns the number of entries by status.
+    """
+    from collections import Counter
+
+    from .layers.tree import UNCHANGED
+
+    result = Counter()
+    for i_entry in entries:
+        result[i_entry.status] += 1
+        if i_entry.status == UNCHANGED:
+            continue
+        click.echo(f"{i_entry.status}: {i_entry.filename}")
+        if i_entry.diff:
+            click.echo(i_entry.diff, nl=False)
+    return result
+
+
+def _format_stats(stats):
+    from .layers.tree import CREATED, UNCHANGED, WRITTEN
+
+    counts = ["{} {}".format(stats[i], i) for i in (CREATED, WRITTEN)]
+    counts += [
+        "{} {}".format(j, i)
+        for i, j in sorted(stats.items())
+        if i not in (CREATED, WRITTEN, UNCHANGED)
+    ]
+    counts.append("{} {}".format(stats[UNCHANGED], UNCHANGED))
+    return "Files: {}.".format(", ".join(counts))
+
+
+@main.command()
+@click.argument("directory", default=".")
+@click.option("--features-file", default=None, envvar="ZOPS_ANATOMY_FEATURES")
+@click.option("--templates-dir", default=None, envvar="ZOPS_ANATOMY_TEMPLATES")
+@click.option("--cache-dir", default=None, envvar="ZOPS_ANATOMY_CACHE_DIR")
+@click.option("--file", "file_id", default=None, help="Only features creating this file.")
+@click.option(
+    "--template", default=None, help="Only features with files using this template."
+)
+def tree(directory, features_file, templates_dir, cache_dir, file_id, template):
+    """
+    List the files created by each feature.
+    """
+    features_file = features_file or _find_features_file(directory)
+    templates_dir = templates_dir or os.path.join(
+        os.path.dirname(features_file), "templates"
+    )
+    registry = _register_features(features_file, templates_dir, cache_dir)
+
+    if file_id is not None:
+        feature_names = registry.file_features(file_id)
+    elif template is not None:
+        feature_names = registry.template_features(template)
+    else:
+        feature_names = list(registry.feature_registry.keys())
+
+    for i_name in feature_names:
+        for j_file_id in registry.feature_files(i_name):
+            click.echo(f"{i_name}: {j_file_id}")
+
+
+@main.command("prune-cache")
+@click.option("--cache-dir", required=True, envvar="ZOPS_ANATOMY_CACHE_DIR")
+@click.option("--max-age", default=7, help="Maximum age in days of unused entries.")
+def prune_cache(cache_dir, max_age):
+    """
+    Remove stale entries from the templates cache.
+    """
+    bytecode_cache = _set_bytecode_cache(cache_dir)
+    count = bytecode_cache.prune(max_age * 24 * 60 * 60)
+    Console.info(f"Removed {count} stale cache entries from {cache_dir}.")
+
+
+def _set_bytecode_cache(cache_dir):
+    from .layers.templates import AnatomyBytecodeCache
+    from .layers.tree import TemplateEngine
+
+    result = AnatomyBytecodeCache(os.path.join(cache_dir, "bytecode"))
+    TemplateEngine.get().set_bytecode_cache(result)
+    return result
 
 
 def _find_features_file(path):
@@ -81,8 +457,13 @@ def _find_features_file(path):
     return result
 
 
-def _register_features(filename, templates_dir):
+def _register_features(filename, templates_dir, cache_dir=None):
     from .layers.feature import AnatomyFeatureRegistry
 
-    AnatomyFeatureRegistry.clear()
-    AnatomyFeatureRegistry.register_from_file(filename, templates_dir)
+    if cache_dir is not None:
+        snapshot_dir = os.path.join(cache_dir, "features")
+    else:
+        snapshot_dir = None
+    return AnatomyFeatureRegistry.from_file(
+        filename, templates_dir, snapshot_dir=snapshot_dir
+    )
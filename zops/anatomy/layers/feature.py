@@ -10,16 +10,125 @@ class FeatureAlreadyRegistered(KeyError):
     pass
 
 
+class FeatureDependencyCycle(RuntimeError):
+    pass
+
+
+class _DefaultInstanceMethod(object):
+    """
+    Method that, when accessed through the class, is bound to the class default instance.
+    """
+
+    def __init__(self, function):
+        self.__function = function
+        self.__doc__ = function.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            instance = owner.default()
+        return self.__function.__get__(instance, owner)
+
+
+class _DefaultInstanceAttribute(object):
+    """
+    Attribute that, when accessed through the class, returns the value from the class default instance.
+
+    Since this is a non-data descriptor, the value stored in the instance takes precedence when accessing instances.
+    """
+
+    def __set_name__(self, owner, name):
+        self.__name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            instance = owner.default()
+        return instance.__dict__[self.__name]
+
+
 class AnatomyFeatureRegistry(object):
+    """
+    A set of features, by name.
+
+    Registries are instances passed to playbooks and features. For compatibility, the methods can also be called on
+    the class itself, acting on a default (global) instance.
+
+    Usage:
+        registry = AnatomyFeatureRegistry()
+        registry.register_from_file('anatomy-features.yml', 'templates')
+        playbook = AnatomyPlaybook.from_file('anatomy-playbook.yml', registry=registry)
+    """
+
+    __default = None
 
-    feature_registry = OrderedDict()
+    feature_registry = _DefaultInstanceAttribute()
+
+    def __init__(self):
+        self.feature_registry = OrderedDict()
+        self.__closures = {}
+        self.__reset_indexes()
+
+    def __reset_indexes(self):
+        # file-id -> feature names, feature name -> file-ids and template -> feature names.
+        self.__file_features = OrderedDict()
+        self.__feature_files = OrderedDict()
+        self.__template_features = OrderedDict()
 
     @classmethod
-    def clear(cls):
-        cls.feature_registry = OrderedDict()
+    def default(cls):
+        """
+        Returns the default registry, used when calling the registry methods on the class.
+
+        :return AnatomyFeatureRegistry:
+        """
+        if AnatomyFeatureRegistry.__default is None:
+            AnatomyFeatureRegistry.__default = AnatomyFeatureRegistry()
+        return AnatomyFeatureRegistry.__default
 
     @classmethod
-    def get(cls, feature_name):
+    def from_file(cls, filename, templates_dir, snapshot_dir=None):
+        """
+        Returns a registry with the features from the given file.
+
+        Registries are memoized per (filename, templates_dir) while the file doesn't change, so callers must not
+        register other features on the result.
+
+        :param str filename:
+        :param str templates_dir:
+        :param str snapshot_dir:
+            If given, a snapshot of the parsed registry is kept in this directory, keyed by the file modification time
+            and hash, so the next processes skip parsing the YAML file.
+        :return AnatomyFeatureRegistry:
+        """
+        import os
+
+        key = (os.path.abspath(filename), templates_dir)
+        stat = os.stat(filename)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = _registries_by_file.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        result = None
+        if snapshot_dir is not None:
+            snapshot = _RegistrySnapshot(snapshot_dir, key, signature)
+            result = snapshot.load()
+        if result is None:
+            result = cls()
+            result.register_from_file(filename, templates_dir)
+            if snapshot_dir is not None:
+                snapshot.save(result)
+
+        _registries_by_file[key] = (signature, result)
+        return result
+
+    @_DefaultInstanceMethod
+    def clear(self):
+        self.feature_registry = OrderedDict()
+        self.__closures = {}
+        self.__reset_indexes()
+
+    @_DefaultInstanceMethod
+    def get(self, feature_name):
         """
         Returns a previously registered feature associated with the given feature_name.
 
@@ -27,40 +136,135 @@ class AnatomyFeatureRegistry(object):
         :return AnatomyFeature:
         """
         try:
-            return cls.feature_registry[feature_name]
+            return self.feature_registry[feature_name]
         except KeyError:
             raise FeatureNotFound(feature_name)
 
-    @classmethod
-    def register(cls, feature_name, feature):
+    @_DefaultInstanceMethod
+    def register(self, feature_name, feature):
         """
         Registers a feature instance to a name.
 
         :param str feature_name:
         :param AnatomyFeature feature:
         """
-        if feature_name in cls.feature_registry:
+        if feature_name in self.feature_registry:
             raise FeatureAlreadyRegistered(feature_name)
-        cls.feature_registry[feature_name] = feature
+        self.feature_registry[feature_name] = feature
+        self.__closures = {}
+
+        # NOTE: The indexes reflect the feature files at registration time.
+        filenames = tuple(feature.filenames())
+        self.__feature_files[feature_name] = filenames
+        for i_filename in filenames:
+            self.__file_features.setdefault(i_filename, []).append(feature_name)
+        for i_template in feature.templates():
+            self.__template_features.setdefault(i_template, []).append(feature_name)
+
+    @_DefaultInstanceMethod
+    def file_features(self, file_id):
+        """
+        Returns the features that create the given file.
 
-    @classmethod
-    def register_from_file(cls, filename, templates_dir):
+        :param str file_id:
+        :return list(str):
+        """
+        return list(self.__file_features.get(file_id, []))
+
+    @_DefaultInstanceMethod
+    def feature_files(self, feature_name):
+        """
+        Returns the file-ids created by the given feature.
+
+        :param str feature_name:
+        :return tuple(str):
+        """
+        try:
+            return self.__feature_files[feature_name]
+        except KeyError:
+            raise FeatureNotFound(feature_name)
+
+    @_DefaultInstanceMethod
+    def template_features(self, template):
+        """
+        Returns the features with files using the given template (create-file with "template").
+
+        :param str template:
+        :return list(str):
+        """
+        return list(self.__template_features.get(template, []))
+
+    @_DefaultInstanceMethod
+    def closure(self, feature_name):
+        """
+        Returns the given feature and, transitively, all features it uses, in topological order (a feature always comes
+        after the features it uses).
+
+        The closure of each feature is computed only once.
+
+        :param str feature_name:
+        :return tuple(str):
+        :raises FeatureDependencyCycle:
+        """
+        try:
+            return self.__closures[feature_name]
+        except KeyError:
+            pass
+        self._compute_closure(feature_name, [], set())
+        return self.__closures[feature_name]
+
+    @_DefaultInstanceMethod
+    def resolve(self, feature_names):
+        """
+        Returns the given features and all features they use, in topological order.
+
+        :param iterable(str) feature_names:
+        :return OrderedDict(str, AnatomyFeature):
+        """
+        result = OrderedDict()
+        for i_name in feature_names:
+            for j_name in self.closure(i_name):
+                if j_name not in result:
+                    result[j_name] = self.get(j_name)
+        return result
+
+    def _compute_closure(self, feature_name, path, visiting):
+        if feature_name in visiting:
+            cycle = path[path.index(feature_name) :] + [feature_name]
+            raise FeatureDependencyCycle(" -> ".join(cycle))
+
+        path.append(feature_name)
+        visiting.add(feature_name)
+        result = OrderedDict()
+        for i_name in self.get(feature_name).use_features:
+            if i_name not in self.__closures:
+                self._compute_closure(i_name, path, visiting)
+            for j_name in self.__closures[i_name]:
+                result[j_name] = None
+        result[feature_name] = None
+        visiting.remove(feature_name)
+        path.pop()
+
+        self.__closures[feature_name] = tuple(result)
+
+    @_DefaultInstanceMethod
+    def register_from_file(self, filename, templates_dir):
         from zerotk.lib.yaml import yaml_from_file
 
         contents = yaml_from_file(filename)
-        return cls.register_from_contents(contents, templates_dir)
+        return self.register_from_contents(contents, templates_dir)
 
-    @classmethod
-    def register_from_text(cls, text):
+    @_DefaultInstanceMethod
+    def register_from_text(self, text):
         from zerotk.lib.yaml import yaml_load
         from zerotk.lib.text import dedent
 
         text = dedent(text)
         contents = yaml_load(text)
-        return cls.register_from_contents(contents, templates_dir="")
+        return self.register_from_contents(contents, templates_dir="")
 
-    @classmethod
-    def register_from_contents(cls, contents, templates_dir):
+    @_DefaultInstanceMethod
+    def register_from_contents(self, contents, templates_dir):
         feature = AnatomyFeature.from_contents(
             {
                 "name": "ANATOMY",
@@ -70,31 +274,100 @@ class AnatomyFeatureRegistry(object):
                 },
             },
         )
-        cls.register(feature.name, feature)
+        self.register(feature.name, feature)
 
         for i_feature in contents["anatomy-features"]:
             feature = AnatomyFeature.from_contents(i_feature)
-            cls.register(feature.name, feature)
+            self.register(feature.name, feature)
 
-    @classmethod
-    def tree(cls):
+    @_DefaultInstanceMethod
+    def tree(self):
         """
         Returns all files created by the registered features.
 
         This is part of the helper functions for the end-user. Since the user must know all the file-ids in order to add
         contents to the files we'll need a way to list all files and their IDs.
 
+        NOTE: The file-id is the filename declared by the feature: it's the key used by the tree and by the playbook
+        variables to override the filename ("<file-id>.filename").
+
         :return 3-tupple(str, str, str):
             Returns a tuple containing:
                 [0]:    Feature name
                 [1]:    File-id
                 [2]:    Filename
         """
-        result = []
-        for i_name, i_feature in cls.feature_registry.items():
-            for j_filename in i_feature.filenames():
-                result.append((i_name, j_filename, j_filename))
-        return result
+        return [
+            (i_name, j_file_id, j_file_id)
+            for i_name, i_file_ids in self.__feature_files.items()
+            for j_file_id in i_file_ids
+        ]
+
+
+# Registries created by AnatomyFeatureRegistry.from_file: {(filename, templates_dir): (signature, registry)}
+_registries_by_file = {}
+
+
+class _RegistrySnapshot(object):
+    """
+    A pickled AnatomyFeatureRegistry stored on disk, valid while the features file keeps its modification time and
+    hash.
+    """
+
+    VERSION = 5
+
+    def __init__(self, directory, key, signature):
+        import hashlib
+        import os
+
+        filename, _templates_dir = key
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        self.__filename = os.path.join(directory, name + ".pickle")
+        self.__source = filename
+        self.__signature = signature
+        self.__digest = None
+
+    def _digest(self):
+        import hashlib
+
+        if self.__digest is None:
+            with open(self.__source, "rb") as iss:
+                self.__digest = hashlib.sha256(iss.read()).hexdigest()
+        return self.__digest
+
+    def load(self):
+        """
+        :return AnatomyFeatureRegistry|None:
+            Returns the registry from the snapshot or None if there's no valid snapshot.
+        """
+        import pickle
+
+        try:
+            with open(self.__filename, "rb") as iss:
+                header = pickle.load(iss)
+                if header != (self.VERSION, self.__signature, self._digest()):
+                    return None
+                return pickle.load(iss)
+        except Exception:
+            return None
+
+    def save(self, registry):
+        import os
+        import pickle
+        import tempfile
+
+        directory = os.path.dirname(self.__filename)
+        os.makedirs(directory, exist_ok=True)
+        header = (self.VERSION, self.__signature, self._digest())
+        fd, temp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as oss:
+                pickle.dump(header, oss, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(registry, oss, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_filename, self.__filename)
+        except BaseException:
+            os.unlink(temp_filename)
+            raise
 
 
 class IAnatomyFeature(object):
@@ -138,15 +411,55 @@ class AnatomyFeature(IAnatomyFeature):
 
     def __init__(self, name, variables=None, use_features=None, condition="True"):
         super().__init__(name)
-        self.__condition = condition
+        self.__condition = None if condition in (True, "True") else condition
         self.__variables = OrderedDict()
         self.__variables[name] = variables or OrderedDict()
         self.__use_features = use_features or OrderedDict()
-        self.__enabled = True
         self.__files = []
 
-    def is_enabled(self):
-        return self.__enabled
+    @property
+    def condition(self):
+        """
+        The expression that must hold for the feature to be used by a playbook, or None if the feature is
+        unconditional.
+
+        :return str:
+        """
+        return self.__condition
+
+    def evaluate_condition(self, variables):
+        """
+        Returns whether this feature condition holds for the given variables. The condition is a jinja2 expression (eg.:
+        "PROJECT.python == 'alpha'"), compiled once.
+
+        :param dict variables:
+        :return bool:
+        :raises RuntimeError:
+            If the condition uses an undefined variable, so a typo doesn't silently drop the feature.
+        """
+        from .tree import TemplateEngine, UndefinedVariableInTemplate
+
+        if self.__condition is None:
+            return True
+        if not isinstance(self.__condition, str):
+            return bool(self.__condition)
+        try:
+            return bool(TemplateEngine.get().evaluate(self.__condition, variables))
+        except UndefinedVariableInTemplate as e:
+            raise RuntimeError(
+                "ERROR: {}: condition {}: {}".format(
+                    self.name, self.__condition, e.args[0]
+                )
+            )
+
+    @property
+    def variables(self):
+        """
+        The default variables of this feature.
+
+        :return OrderedDict:
+        """
+        return self.__variables[self.name]
 
     @classmethod
     def from_contents(cls, contents):
@@ -193,14 +506,22 @@ class AnatomyFeature(IAnatomyFeature):
     def filename(self):
         raise NotImplementedError()
 
-    def apply(self, tree):
+    def apply(self, tree, enabled=True):
         """
         Implements AnatomyFeature.apply.
+
+        Features are shared by the playbooks using a registry, so whether a feature is enabled (eg.: skip-features) is
+        decided by each playbook (see AnatomyPlaybook._resolve_features).
+
+        :param bool enabled:
+            A disabled feature adds its variables to the tree, but no files.
+        :return bool:
+            Returns enabled.
         """
         tree.add_variables(self.__use_features, left_join=True)
         tree.add_variables(self.__variables, left_join=False)
 
-        result = self.is_enabled()
+        result = enabled
         if result and self.__files:
             for i_file in self.__files:
                 if i_file.contents:
@@ -213,11 +534,31 @@ class AnatomyFeature(IAnatomyFeature):
                     )
         return result
 
-    def using_features(self, features, skipped):
-        self.__enabled = self.name not in skipped
-        for i_name, i_vars in self.__use_features.items():
-            feature = AnatomyFeatureRegistry.get(i_name)
-            feature.using_features(features, skipped)
+    @property
+    def use_features(self):
+        """
+        The features used by this feature, mapped to the variables it sets on them.
+
+        :return OrderedDict:
+        """
+        return self.__use_features
+
+    def using_features(self, features, *, registry=None):
+        """
+        Adds this feature and, transitively, the features it uses to the given features dict, in topological order.
+
+        The skipped features are no longer passed here (these were stored in the shared features): see
+        AnatomyPlaybook skip-features.
+
+        :param OrderedDict features:
+        :param AnatomyFeatureRegistry registry:
+            The registry used to find the used features. Defaults to AnatomyFeatureRegistry.default().
+        """
+        registry = registry or AnatomyFeatureRegistry.default()
+        for i_name in self.__use_features:
+            for j_name in registry.closure(i_name):
+                if j_name not in features:
+                    features[j_name] = registry.get(j_name)
         # DEBUGGING: print('using anatomy-feature {} ({})'.format(self.name, id(self)))
         feature = features.get(self.name)
         if feature is None:
@@ -247,3 +588,15 @@ class AnatomyFeature(IAnatomyFeature):
 
     def filenames(self):
         return [i.filename for i in self.__files]
+
+    def templates(self):
+        """
+        Returns the templates used by this feature files (see create-file "template").
+
+        :return list(str):
+        """
+        return [
+            i.contents[1:]
+            for i in self.__files
+            if i.contents is not None and i.contents.startswith("!")
+        ]
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+
+
+class AnatomyManifest(object):
+    """
+    Records a fingerprint of each file generated in a directory, allowing the next apply to skip the files whose
+    fingerprint didn't change.
+
+    The manifest is stored in the target directory (see FILENAME). Each entry holds the file fingerprint (see
+    AnatomyFile.fingerprint), the variables found while rendering the file (which are part of the next fingerprint)
+    and the hash, size, mode and modification time of the generated file so changes made on disk after the apply are
+    detected.
+
+    Usage:
+        manifest = AnatomyManifest.load('directory')
+        dependencies = manifest.dependencies('directory/alpha.txt')
+        if not manifest.is_current('directory/alpha.txt', fingerprint):
+            ...  # Create the file.
+        manifest.update('directory/alpha.txt', fingerprint, dependencies)
+        manifest.save()
+    """
+
+    FILENAME = ".anatomy-manifest.json"
+    VERSION = 2
+
+    def __init__(self, directory, entries=None):
+        self.directory = directory
+        self.__entries = entries or {}
+        self.__updated = {}
+
+    @property
+    def filename(self):
+        return os.path.join(self.directory, self.FILENAME)
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Loads the manifest from the given directory. Returns an empty manifest if there's no valid manifest there.
+
+        :param str directory:
+        :return AnatomyManifest:
+        """
+        result = cls(directory)
+        try:
+            with open(result.filename) as iss:
+                contents = json.load(iss)
+        except (OSError, ValueError):
+            return result
+        if isinstance(contents, dict) and contents.get("version") == cls.VERSION:
+            result.__entries = contents.get("files", {})
+        return result
+
+    def save(self):
+        """
+        Writes the manifest. Only the entries updated since the manifest was loaded are kept.
+        """
+        contents = dict(version=self.VERSION, files=self.__updated)
+        with open(self.filename, "w") as oss:
+            json.dump(contents, oss, indent=1, sort_keys=True)
+
+    def is_current(self, filename, fingerprint):
+        """
+        Returns whether the given file was generated with the given fingerprint and was not changed since.
+
+        :param str filename:
+        :param str|None fingerprint:
+            None is never current.
+        :return bool:
+        """
+        key = self._key(filename)
+        entry = self.__entries.get(key)
+        if entry is None or fingerprint is None or entry["fingerprint"] != fingerprint:
+            return False
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        if os.path.islink(filename) or stat.st_size != entry["size"]:
+            return False
+        if stat.st_mode & 0o777 != entry["mode"]:
+            return False
+        if stat.st_mtime_ns != entry["mtime_ns"]:
+            if file_hash(filename) != entry["sha256"]:
+                return False
+            entry = dict(entry, mtime_ns=stat.st_mtime_ns)
+        self.__updated[key] = entry
+        return True
+
+    def dependencies(self, filename):
+        """
+        Returns the variable paths recorded for the given file (see update).
+
+        :param str filename:
+        :return list(str):
+        """
+        entry = self.__entries.get(self._key(filename))
+        if entry is None:
+            return []
+        return entry.get("dependencies", [])
+
+    def update(self, filename, fingerprint, dependencies=()):
+        """
+        Records the given file, as it's on disk, as generated with the given fingerprint.
+
+        :param str filename:
+        :param str|None fingerprint:
+        :param list(str) dependencies:
+            The variable paths found while rendering the file (see AnatomyFile.fingerprint).
+        """
+        stat = os.stat(filename)
+        self.__updated[self._key(filename)] = dict(
+            fingerprint=fingerprint,
+            dependencies=list(dependencies),
+            sha256=file_hash(filename),
+            size=stat.st_size,
+            mode=stat.st_mode & 0o777,
+            mtime_ns=stat.st_mtime_ns,
+        )
+
+    def _key(self, filename):
+        return os.path.relpath(filename, self.directory)
+
+
+def file_hash(filename):
+    """
+    :param str filename:
+    :return str:
+        Returns the SHA-256 hex digest of the given file contents.
+    """
+    result = hashlib.sha256()
+    with open(filename, "rb") as iss:
+        for i_chunk in iter(lambda: iss.read(1024 * 1024), b""):
+            result.update(i_chunk)
+    return result.hexdigest()
+
+
+def fingerprint(*values):
+    """
+    :return str:
+        Returns a SHA-256 hex digest of the given values, serialized as JSON.
+    """
+    contents = json.dumps(values, sort_keys=True, default=repr)
+    return hashlib.sha256(contents.encode("utf-8")).hexdigest()
@@ -1,5 +1,4 @@
 from zops.anatomy.layers.feature import AnatomyFeatureRegistry
-from zerotk.lib.yaml import yaml_from_file
 
 from collections import OrderedDict
 
@@ -7,36 +6,52 @@ from collections import OrderedDict
 class AnatomyPlaybook(object):
     """
     Describes features and variables to apply in a project tree.
+
+    Features with a condition (see AnatomyFeature.evaluate_condition) are dropped when it doesn't hold, along with the
+    features used only by them (see _resolve_features).
     """
 
-    def __init__(self, condition=True):
+    def __init__(self, condition=True, registry=None):
+        self.__registry = registry or AnatomyFeatureRegistry.default()
         self.__features = OrderedDict()
+        self.__used = []
+        self.__skipped = set()
         self.__variables = {}
 
     @classmethod
     def get_template_name(cls, filename):
+        from zerotk.lib.yaml import yaml_from_file
+
         contents = yaml_from_file(filename)
         return contents.pop("anatomy-template", "application")
 
     @classmethod
-    def from_file(cls, filename):
+    def from_file(cls, filename, registry=None):
+        from zerotk.lib.yaml import yaml_from_file
+
         contents = yaml_from_file(filename)
-        result = cls.from_contents(contents)
+        result = cls.from_contents(contents, registry=registry)
         return result
 
     @classmethod
-    def from_contents(cls, contents):
-        result = cls()
-        result.__use_feature("ANATOMY", [])
+    def from_contents(cls, contents, registry=None):
+        """
+        :param dict contents:
+        :param AnatomyFeatureRegistry registry:
+            The registry with the features used by the playbook. Defaults to AnatomyFeatureRegistry.default().
+        :return AnatomyPlaybook:
+        """
+        result = cls(registry=registry)
+        result.__use_feature("ANATOMY")
         contents = contents.pop("anatomy-playbook", contents)
         use_features = contents.pop("use-features")
         if not isinstance(use_features, dict):
             raise TypeError(
                 'Use-features must be a dict not "{}"'.format(use_features.__class__)
             )
-        skip_features = contents.pop("skip-features", [])
+        result.__skipped.update(contents.pop("skip-features", []))
         for i_feature_name, i_variables in use_features.items():
-            result.__use_feature(i_feature_name, skip_features)
+            result.__use_feature(i_feature_name)
             i_variables = cls._process_variables(i_variables)
             result.set_variables(i_feature_name, i_variables)
 
@@ -49,9 +64,10 @@ class AnatomyPlaybook(object):
     def _process_variables(cls, variables):
         return variables
 
-    def __use_feature(self, feature_name, skipped):
-        feature = AnatomyFeatureRegistry.get(feature_name)
-        feature.using_features(self.__features, skipped)
+    def __use_feature(self, feature_name):
+        feature = self.__registry.get(feature_name)
+        feature.using_features(self.__features, registry=self.__registry)
+        self.__used.append(feature_name)
 
     def set_variables(self, feature_name, variables):
         """
@@ -61,19 +77,179 @@ class AnatomyPlaybook(object):
         assert feature_name not in self.__variables
         self.__variables[feature_name] = variables
 
-    def apply(self, directory):
-        from zops.anatomy.layers.tree import AnatomyTree
+    def apply(
+        self,
+        directory,
+        incremental=False,
+        jobs=1,
+        atomic=False,
+        fsync=True,
+        sink=None,
+        streaming=False,
+        profile=None,
+    ):
+        """
+        Applies the playbook features in the given directory.
+
+        :param str directory:
+        :param bool incremental:
+        :param int jobs:
+        :param bool atomic:
+        :param bool fsync:
+        :param AnatomySink sink:
+        :param bool streaming:
+            See AnatomyTree.apply.
+        :param AnatomyProfile profile:
+            If given, records the timings of the apply, per feature and per file (see AnatomyProfile).
+        :return Counter:
+            Returns the number of files created, written and unchanged (see AnatomyTree.apply).
+        """
         import os
 
-        tree = AnatomyTree()
+        tree, variables = self._create_tree(profile)
 
-        if not os.path.isdir(directory):
+        if sink is None and not os.path.isdir(directory):
             os.makedirs(directory)
 
+        print("Applying anatomy-tree.")
+        return tree.apply(
+            directory,
+            variables,
+            incremental=incremental,
+            jobs=jobs,
+            atomic=atomic,
+            fsync=fsync,
+            sink=sink,
+            streaming=streaming,
+        )
+
+    def plan(self, directory, diff=False, jobs=1):
+        """
+        Reports what apply would change in the given directory, without writing anything.
+
+        :param str directory:
+        :param bool diff:
+        :param int jobs:
+            See AnatomyTree.plan.
+        :return list(AnatomyPlanEntry):
+        """
+        tree, variables = self._create_tree()
+        print("Planning anatomy-tree.")
+        return tree.plan(directory, variables, diff=diff, jobs=jobs)
+
+    def iter_render(self, directory, jobs=1):
+        """
+        Renders the playbook files one at a time, without writing them.
+
+        :param str directory:
+        :param int jobs:
+            See AnatomyTree.iter_render.
+        :return iter(AnatomyRecord):
+        """
+        tree, variables = self._create_tree()
+        return tree.iter_render(directory, variables, jobs=jobs)
+
+    def _create_tree(self, profile=None):
+        """
+        :return 2-tuple(AnatomyTree, dict):
+            Returns the tree with the resolved features and the playbook variables for these features.
+        """
+        from zops.anatomy.layers.profile import NULL_PROFILE
+        from zops.anatomy.layers.tree import AnatomyTree
+
+        result = AnatomyTree()
+        result.profile = profile
+        profile = profile or NULL_PROFILE
+        with profile.measure("features"):
+            features = self._resolve_features()
         print("Applying features:")
-        for i_feature_name, i_feature in self.__features.items():
-            i_feature.apply(tree)
+        for i_feature_name, i_enabled in features.items():
+            i_feature = self.__features[i_feature_name]
+            with profile.measure("variables", feature=i_feature_name):
+                enabled = i_feature.apply(
+                    result, enabled=i_enabled and i_feature_name not in self.__skipped
+                )
+            if enabled:
+                profile.add_feature_files(i_feature_name, i_feature.filenames())
             print(" * {}".format(i_feature_name))
+        variables = {k: v for k, v in self.__variables.items() if k in features}
+        return result, variables
 
-        print("Applying anatomy-tree.")
-        tree.apply(directory, self.__variables)
+    def _resolve_features(self):
+        """
+        Evaluates the features conditions, starting from the features used by the playbook.
+
+        A feature is enabled if its condition holds and it is used by the playbook or by an enabled feature. The
+        features used by enabled features are also applied, since these set their variables, but disabled if not
+        enabled themselves. All other features (and their variables) are dropped.
+
+        The conditions see the default variables of all features used by the playbook, with the playbook variables
+        (see _get_condition_variables). The variables of registered features not used by the playbook are None, so
+        a condition on an unused feature doesn't hold.
+
+        :return OrderedDict(str, bool):
+            Maps the features to apply, in topological order, to whether they are enabled.
+        """
+        variables = None
+        if any(i.condition is not None for i in self.__features.values()):
+            variables = self._get_condition_variables()
+
+        enabled = set()
+        pending = list(reversed(self.__used))
+        while pending:
+            name = pending.pop()
+            if name in enabled:
+                continue
+            feature = self.__features[name]
+            if feature.condition is not None and not feature.evaluate_condition(
+                variables
+            ):
+                continue
+            enabled.add(name)
+            pending.extend(reversed(feature.use_features))
+
+        required = set()
+        for i_name in enabled:
+            required.update(self.__registry.closure(i_name))
+        return OrderedDict(
+            (i_name, i_name in enabled)
+            for i_name in self.__features
+            if i_name in required
+        )
+
+    def _get_condition_variables(self):
+        """
+        Returns the default variables of the features used by the playbook, with the playbook variables. The variables
+        set by features on the features they use (use-features) are not merged, since these depend on the conditions.
+
+        :return dict:
+        """
+        from zops.anatomy.layers.tree import AnatomyVariables
+
+        variables = AnatomyVariables()
+        variables.add(
+            {i.name: i.variables for i in self.__features.values()}, left_join=False
+        )
+        variables.add(self.__variables)
+        result = dict(variables.materialize())
+        for i_name in self.__registry.feature_registry:
+            result.setdefault(i_name, _UNUSED_FEATURE)
+        return result
+
+
+class _UnusedFeature(object):
+    """
+    The variables of a feature not used by the playbook, as seen by the conditions: all None.
+    """
+
+    def __getattr__(self, name):
+        return None
+
+    def __getitem__(self, name):
+        return None
+
+    def __bool__(self):
+        return False
+
+
+_UNUSED_FEATURE = _UnusedFeature()
@@ -0,0 +1,187 @@
+import contextlib
+import time
+
+
+class AnatomyProfile(object):
+    """
+    Collects the time spent in each phase of an apply, with per-file and per-feature breakdowns.
+
+    The phases are:
+        registry: Loading the features file.
+        features: Resolving the features used by the playbook.
+        variables: Merging the features variables.
+        filename: Expanding the filenames.
+        template: Resolving and loading the "!template" sources.
+        render: Expanding the contents (see iterations).
+        write: Writing the files.
+
+    Profiling is enabled by assigning a profile to AnatomyTree.profile (or passing one to AnatomyPlaybook.apply).
+
+    Usage:
+        tree.profile = AnatomyProfile()
+        tree.apply('directory')
+        tree.profile.save('profile.json')
+    """
+
+    PHASES = ("registry", "features", "variables", "filename", "template", "render", "write")
+
+    def __init__(self):
+        self.phases = {}
+        self.files = {}
+        self.features = {}
+
+    @contextlib.contextmanager
+    def measure(self, phase, filename=None, feature=None):
+        """
+        Measures the time spent in the context as the given phase. See add.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start, filename, feature)
+
+    def add(self, phase, seconds, filename=None, feature=None):
+        """
+        :param str phase:
+        :param float seconds:
+        :param str filename:
+            If given, also adds the time to this file.
+        :param str feature:
+            If given, also adds the time to this feature.
+        """
+        phase_stats = self.phases.setdefault(phase, dict(seconds=0.0, count=0))
+        phase_stats["seconds"] += seconds
+        phase_stats["count"] += 1
+        if filename is not None:
+            file_stats = self.file(filename)
+            file_stats[phase] = file_stats.get(phase, 0.0) + seconds
+        if feature is not None:
+            feature_stats = self.features.setdefault(
+                feature, dict(seconds=0.0, fileids=[])
+            )
+            feature_stats["seconds"] += seconds
+
+    def file(self, filename):
+        """
+        Returns the stats of the given file: the seconds in each phase plus the "fileid", "source" (the contents template),
+        "iterations" (fixed-point expansion passes) and "dependencies" (see TemplateEngine.expand) of the file, when
+        known.
+
+        :param str filename:
+        :return dict:
+        """
+        return self.files.setdefault(filename, {})
+
+    def add_feature_files(self, feature, fileids):
+        """
+        Associates the given file-ids to the feature, so the files time is part of the feature breakdown.
+        """
+        feature_stats = self.features.setdefault(feature, dict(seconds=0.0, fileids=[]))
+        feature_stats["fileids"].extend(fileids)
+
+    def update(self, files):
+        """
+        Adds the given files stats (eg.: collected by a worker process, see file).
+
+        :param dict files:
+        """
+        for i_filename, i_stats in files.items():
+            file_stats = self.file(i_filename)
+            for j_key, j_value in i_stats.items():
+                if j_key in self.PHASES:
+                    self.add(j_key, j_value)
+                    file_stats[j_key] = file_stats.get(j_key, 0.0) + j_value
+                else:
+                    file_stats[j_key] = j_value
+
+    def to_dict(self, top=10):
+        """
+        :param int top:
+            The number of slowest templates to report.
+        :return dict:
+        """
+        file_seconds = {
+            i_filename: sum(v for k, v in i_stats.items() if k in self.PHASES)
+            for i_filename, i_stats in self.files.items()
+        }
+        fileid_seconds = {}
+        templates = {}
+        for i_filename, i_stats in self.files.items():
+            fileid = i_stats.get("fileid")
+            if fileid is not None:
+                fileid_seconds[fileid] = (
+                    fileid_seconds.get(fileid, 0.0) + file_seconds[i_filename]
+                )
+            template = i_stats.get("source")
+            if template is not None:
+                template_stats = templates.setdefault(
+                    template, dict(seconds=0.0, count=0)
+                )
+                template_stats["seconds"] += i_stats.get("render", 0.0)
+                template_stats["count"] += 1
+
+        features = {}
+        for i_feature, i_stats in self.features.items():
+            files_seconds = sum(fileid_seconds.get(i, 0.0) for i in i_stats["fileids"])
+            features[i_feature] = dict(
+                seconds=i_stats["seconds"] + files_seconds,
+                apply=i_stats["seconds"],
+                files=files_seconds,
+            )
+
+        slowest = sorted(templates.items(), key=lambda i: i[1]["seconds"], reverse=True)
+        return dict(
+            total=sum(i["seconds"] for i in self.phases.values()),
+            phases=self.phases,
+            features=features,
+            files={
+                i_filename: dict(
+                    _serializable(i_stats), seconds=file_seconds[i_filename]
+                )
+                for i_filename, i_stats in self.files.items()
+            },
+            templates=[dict(template=k, **v) for k, v in slowest[:top]],
+        )
+
+    def save(self, filename, top=10):
+        """
+        Writes the profile (see to_dict) as JSON.
+        """
+        import json
+
+        with open(filename, "w") as oss:
+            json.dump(self.to_dict(top), oss, indent=1, sort_keys=True)
+
+
+def _serializable(stats):
+    return {k: sorted(v) if isinstance(v, set) else v for k, v in stats.items()}
+
+
+class _NullProfile(object):
+    """
+    A disabled profile: measuring costs a single no-op context.
+    """
+
+    _CONTEXT = contextlib.nullcontext()
+
+    def measure(self, phase, filename=None, feature=None):
+        return self._CONTEXT
+
+    def add(self, phase, seconds, filename=None, feature=None):
+        pass
+
+    def file(self, filename):
+        return None
+
+    def add_feature_files(self, feature, fileids):
+        pass
+
+    def update(self, files):
+        pass
+
+    def __bool__(self):
+        return False
+
+
+NULL_PROFILE = _NullProfile()
@@ -0,0 +1,511 @@
+import os
+import posixpath
+import tempfile
+import time
+
+from .tree import CREATED, UNCHANGED, WRITTEN, _read_bytes
+
+
+class AnatomySink(object):
+    """
+    Receives the files and symlinks generated by AnatomyTree.apply.
+
+    A sink used as a context manager is closed on success and aborted on error. Sinks passed to AnatomyTree.apply are
+    not closed by it, so many trees can be applied to the same sink.
+
+    Usage:
+        with AnatomyMemorySink() as sink:
+            tree.apply('', sink=sink)
+        sink.files['alpha.txt'].contents
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, filename, contents, executable=False):
+        """
+        :param str filename:
+        :param bytes contents:
+            The normalized contents (see AnatomyFile.write).
+        :param bool executable:
+        :return str:
+            Returns CREATED, WRITTEN or UNCHANGED.
+        """
+        raise NotImplementedError()
+
+    def write_stream(self, filename, chunks, executable=False):
+        """
+        Like write, but receives the contents as an iterable of bytes chunks. Errors raised by the chunks iterable
+        are propagated, leaving the file as it was.
+
+        The default implementation joins the chunks and calls write.
+
+        :param str filename:
+        :param iter(bytes) chunks:
+        :param bool executable:
+        :return str:
+            Returns CREATED, WRITTEN or UNCHANGED.
+        """
+        return self.write(filename, b"".join(chunks), executable)
+
+    def symlink(self, filename, target):
+        """
+        :param str filename:
+        :param str target:
+            The target relative to the symlink directory.
+        :return str:
+            Returns CREATED, WRITTEN or UNCHANGED.
+        """
+        raise NotImplementedError()
+
+    def make_executable(self, filename):
+        """
+        Copies the read bits to the executable bits of the given file (following symlinks).
+
+        :param str filename:
+        """
+        raise NotImplementedError()
+
+    def is_file(self, filename):
+        """
+        :param str filename:
+        :return bool:
+            Returns whether the given file was written (or already exists) in this sink.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class AnatomyDirectorySink(AnatomySink):
+    """
+    Writes the files directly in the file system, skipping the files that already have the same contents.
+    """
+
+    def write(self, filename, contents, executable=False):
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            result = CREATED
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        else:
+            if stat.st_size == len(contents) and _read_bytes(filename) == contents:
+                result = UNCHANGED
+            else:
+                result = WRITTEN
+
+        if result != UNCHANGED:
+            try:
+                with open(filename, "wb") as oss:
+                    oss.write(contents)
+            except Exception as e:
+                raise RuntimeError(e)
+        if executable:
+            self.make_executable(filename)
+        return result
+
+    def write_stream(self, filename, chunks, executable=False):
+        """
+        Writes the chunks in a temporary file next to the given file, replacing it only if the contents differ.
+        """
+        filename = os.path.realpath(filename)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, temp_filename = mkstemp(filename)
+        write_chunks(fd, temp_filename, chunks)
+
+        result = replace_if_changed(temp_filename, filename)
+        if executable:
+            self.make_executable(filename)
+        return result
+
+    def symlink(self, filename, target):
+        if os.path.islink(filename):
+            if os.readlink(filename) == target:
+                return UNCHANGED
+            result = WRITTEN
+        elif os.path.isfile(filename):
+            result = WRITTEN
+        else:
+            result = CREATED
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        try:
+            if result == WRITTEN:
+                os.unlink(filename)
+            os.symlink(target, filename)
+        except Exception as e:
+            raise RuntimeError(e)
+        return result
+
+    def make_executable(self, filename):
+        mode = os.stat(filename).st_mode
+        new_mode = mode | (mode & 0o444) >> 2  # copy R bits to X
+        if new_mode != mode:
+            os.chmod(filename, new_mode)
+
+    def is_file(self, filename):
+        return os.path.isfile(filename)
+
+
+class AnatomyMemoryEntry(object):
+    """
+    A file (contents) or a symlink (target) in an AnatomyMemorySink.
+    """
+
+    def __init__(self, contents=None, mode=0o644, target=None):
+        self.contents = contents
+        self.mode = mode
+        self.target = target
+
+    @property
+    def executable(self):
+        return bool(self.mode & 0o111)
+
+    def __eq__(self, other):
+        return isinstance(other, AnatomyMemoryEntry) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return "AnatomyMemoryEntry({!r}, {:o}, {!r})".format(
+            self.contents, self.mode, self.target
+        )
+
+
+class AnatomyMemorySink(AnatomySink):
+    """
+    Keeps the generated files in memory, mapping the (normalized) filename to an AnatomyMemoryEntry.
+
+    :ivar dict files:
+    """
+
+    def __init__(self, root=None):
+        """
+        :param str root:
+            If given, the filenames are kept relative to this directory.
+        """
+        self.root = root
+        self.files = {}
+
+    def write(self, filename, contents, executable=False):
+        key = _archive_name(filename, self.root)
+        entry = self.files.get(key)
+        mode = 0o755 if executable else 0o644
+        new_entry = AnatomyMemoryEntry(contents, mode)
+        if entry is None:
+            result = CREATED
+        elif entry == new_entry:
+            result = UNCHANGED
+        else:
+            result = WRITTEN
+        self.files[key] = new_entry
+        return result
+
+    def symlink(self, filename, target):
+        key = _archive_name(filename, self.root)
+        entry = self.files.get(key)
+        new_entry = AnatomyMemoryEntry(mode=0o777, target=target)
+        if entry is None:
+            result = CREATED
+        elif entry == new_entry:
+            result = UNCHANGED
+        else:
+            result = WRITTEN
+        self.files[key] = new_entry
+        return result
+
+    def make_executable(self, filename):
+        entry = self._resolve(_archive_name(filename, self.root))
+        if entry is not None:
+            entry.mode |= (entry.mode & 0o444) >> 2
+
+    def is_file(self, filename):
+        return self._resolve(_archive_name(filename, self.root)) is not None
+
+    def _resolve(self, key):
+        """
+        Returns the file entry for the given key, following symlinks.
+        """
+        seen = set()
+        entry = self.files.get(key)
+        while entry is not None and entry.target is not None and key not in seen:
+            seen.add(key)
+            key = posixpath.join(posixpath.dirname(key), entry.target)
+            key = posixpath.normpath(key)
+            entry = self.files.get(key)
+        if entry is None or entry.target is not None:
+            return None
+        return entry
+
+
+class AnatomyArchiveSink(AnatomySink):
+    """
+    Streams the generated files into a tar or zip archive, which can be a non-seekable stream (eg.: stdout).
+
+    Every file is reported as CREATED, with the time the archive was created. Executable symlinks (see
+    AnatomySymlink) don't change their destination mode, since archive members can't be changed once written.
+
+    Usage:
+        with AnatomyArchiveSink(sys.stdout.buffer, 'tar.gz') as sink:
+            tree.apply('', sink=sink)
+    """
+
+    FORMATS = ("tar", "tar.gz", "tar.bz2", "tar.xz", "zip")
+    SPOOL_SIZE = 1024 * 1024
+
+    def __init__(self, fileobj, format=None, root=None):
+        """
+        :param str|file fileobj:
+            The archive filename or binary file object.
+        :param str format:
+            One of FORMATS. Defaults to the fileobj extension.
+        :param str root:
+            If given, the archive names are relative to this directory.
+        """
+        if format is None:
+            format = self._guess_format(fileobj)
+        if format not in self.FORMATS:
+            raise ValueError("Unknown archive format: {}".format(format))
+        self.format = format
+        self.root = root
+        self.mtime = time.time()
+        self.__names = set()
+        if isinstance(fileobj, (str, os.PathLike)):
+            self.__filename = fileobj
+            self.__file = open(fileobj, "wb")
+            fileobj = self.__file
+        else:
+            self.__filename = None
+            self.__file = None
+        self.__output = fileobj = _ArchiveOutput(fileobj)
+        if format == "zip":
+            import zipfile
+
+            self.__archive = zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED)
+        else:
+            import tarfile
+
+            mode = "w|" + format[4:]
+            self.__archive = tarfile.open(fileobj=fileobj, mode=mode)
+
+    @classmethod
+    def _guess_format(cls, fileobj):
+        name = getattr(fileobj, "name", fileobj)
+        if isinstance(name, (str, os.PathLike)):
+            name = os.fspath(name)
+            for i_format in sorted(cls.FORMATS, key=len, reverse=True):
+                if name.endswith("." + i_format):
+                    return i_format
+        return "tar"
+
+    def write(self, filename, contents, executable=False):
+        mode = 0o755 if executable else 0o644
+        self._add(_archive_name(filename, self.root), mode, contents=contents)
+        return CREATED
+
+    def write_stream(self, filename, chunks, executable=False):
+        """
+        Spools the chunks (in memory up to SPOOL_SIZE) before adding them: tar members need their size up front and
+        a failing chunks iterable must not leave a partial member.
+        """
+        import shutil
+
+        mode = 0o755 if executable else 0o644
+        name = _archive_name(filename, self.root)
+        with tempfile.SpooledTemporaryFile(self.SPOOL_SIZE) as spool:
+            for i_chunk in chunks:
+                spool.write(i_chunk)
+            size = spool.tell()
+            spool.seek(0)
+
+            self.__names.add(name)
+            if self.format == "zip":
+                info = _zip_info(name, mode, self.mtime)
+                with self.__archive.open(info, "w") as oss:
+                    shutil.copyfileobj(spool, oss)
+            else:
+                import tarfile
+
+                info = tarfile.TarInfo(name)
+                info.mode = mode
+                info.mtime = self.mtime
+                info.size = size
+                self.__archive.addfile(info, spool)
+        return CREATED
+
+    def symlink(self, filename, target):
+        self._add(_archive_name(filename, self.root), 0o777, target=target)
+        return CREATED
+
+    def make_executable(self, filename):
+        pass
+
+    def is_file(self, filename):
+        return _archive_name(filename, self.root) in self.__names
+
+    def close(self):
+        self.__archive.close()
+        if self.__file is not None:
+            self.__file.close()
+
+    def abort(self):
+        """
+        Discards the archive: removes the archive file or, for file objects, stops writing without finishing the
+        archive (eg.: the zip central directory or the compression trailer), so it isn't taken for a complete one.
+        """
+        self.__output.discarded = True
+        self.close()
+        if self.__filename is not None:
+            os.unlink(self.__filename)
+
+    def _add(self, name, mode, contents=None, target=None):
+        import stat
+
+        self.__names.add(name)
+        if self.format == "zip":
+            import zipfile
+
+            if target is None:
+                info = _zip_info(name, mode, self.mtime)
+            else:
+                info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+                info.external_attr = (stat.S_IFLNK | mode) << 16
+                contents = target.encode("utf-8")
+            self.__archive.writestr(info, contents)
+        else:
+            import io
+            import tarfile
+
+            info = tarfile.TarInfo(name)
+            info.mode = mode
+            info.mtime = self.mtime
+            if target is None:
+                info.size = len(contents)
+                self.__archive.addfile(info, io.BytesIO(contents))
+            else:
+                info.type = tarfile.SYMTYPE
+                info.linkname = target
+                self.__archive.addfile(info)
+
+
+class _ArchiveOutput(object):
+    """
+    Forwards the writes to the archive file object until discarded (see AnatomyArchiveSink.abort).
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.discarded = False
+
+    def write(self, data):
+        if self.discarded:
+            return len(data)
+        return self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def _zip_info(name, mode, mtime):
+    import stat
+    import zipfile
+
+    result = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+    result.external_attr = (stat.S_IFREG | mode) << 16
+    result.compress_type = zipfile.ZIP_DEFLATED
+    return result
+
+
+def mkstemp(filename, suffix=".tmp"):
+    """
+    Creates a temporary file in the same directory (and file system) of the given file.
+
+    :return 2-tuple(int, str):
+        Returns the file descriptor and the temporary filename.
+    """
+    return tempfile.mkstemp(
+        prefix=".anatomy-", suffix=suffix, dir=os.path.dirname(filename)
+    )
+
+
+def write_chunks(fd, filename, chunks, fsync=False):
+    """
+    Writes the chunks in the given file descriptor, closing it. Removes the file if writing fails.
+
+    :param int fd:
+    :param str filename:
+        The file opened as fd.
+    :param iter(bytes) chunks:
+    :param bool fsync:
+        If True, syncs the file to disk before closing it.
+    """
+    try:
+        with os.fdopen(fd, "wb") as oss:
+            for i_chunk in chunks:
+                oss.write(i_chunk)
+            if fsync:
+                oss.flush()
+                os.fsync(oss.fileno())
+    except BaseException:
+        os.unlink(filename)
+        raise
+
+
+def replace_if_changed(temp_filename, filename):
+    """
+    Moves the temporary file to the given filename, unless the file already has the same contents, keeping the
+    existing file mode.
+
+    :return str:
+        Returns CREATED, WRITTEN or UNCHANGED.
+    """
+    import filecmp
+
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        os.chmod(temp_filename, 0o666 & ~UMASK)
+        result = CREATED
+    else:
+        if filecmp.cmp(temp_filename, filename, shallow=False):
+            os.unlink(temp_filename)
+            return UNCHANGED
+        os.chmod(temp_filename, stat.st_mode & 0o7777)
+        result = WRITTEN
+    os.replace(temp_filename, filename)
+    return result
+
+
+def _read_umask():
+    """
+    Reads the process umask from /proc (Linux 4.7+). Elsewhere, the umask can only be read by changing it for the
+    whole process, which races with the threads creating files, so it is read only once.
+    """
+    try:
+        with open("/proc/self/status") as iss:
+            for i_line in iss:
+                if i_line.startswith("Umask:"):
+                    return int(i_line.split(":")[1], 8)
+    except OSError:
+        pass
+    result = os.umask(0)
+    os.umask(result)
+    return result
+
+
+UMASK = _read_umask()
+
+
+def _archive_name(filename, root=None):
+    if root is not None:
+        filename = os.path.relpath(filename, root)
+    result = posixpath.normpath(filename.replace(os.sep, "/"))
+    return result.lstrip("/")
@@ -0,0 +1,298 @@
+# NOTE: Imports jinja2 at module level: only import this module when templates are actually expanded.
+import hashlib
+import os
+import threading
+import time
+
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, TemplateNotFound
+
+
+class TemplateSourceCache(object):
+    """
+    A cache of template sources validated by the file modification time and size.
+
+    Usage:
+        sources = TemplateSourceCache()
+        source = sources.get('templates/application/setup.cfg')
+    """
+
+    def __init__(self):
+        self.__items = {}
+        self.__lock = threading.Lock()
+
+    def get(self, filename):
+        """
+        Returns the contents of the given file, reading it only if it changed since the last call.
+
+        :param str filename:
+        :return str:
+        """
+        stat = os.stat(filename)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self.__items.get(filename)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        with open(filename) as iss:
+            result = iss.read()
+        with self.__lock:
+            self.__items[filename] = (signature, result)
+        return result
+
+    def is_uptodate(self, filename):
+        cached = self.__items.get(filename)
+        if cached is None:
+            return False
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        return cached[0] == (stat.st_mtime_ns, stat.st_size)
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+
+
+class AnatomyTemplateLoader(BaseLoader):
+    """
+    A jinja2 loader for the templates on ANATOMY.templates_dir using a shared TemplateSourceCache.
+
+    Usage:
+        loader = AnatomyTemplateLoader('templates', TemplateSourceCache())
+        source, filename, uptodate = loader.get_source(env, 'application/setup.cfg')
+    """
+
+    def __init__(self, templates_dir, sources):
+        self.templates_dir = templates_dir
+        self.__sources = sources
+
+    def get_filename(self, template):
+        return "{}/{}".format(self.templates_dir, template)
+
+    def get_source(self, environment, template):
+        filename = self.get_filename(template)
+        try:
+            source = self.__sources.get(filename)
+        except FileNotFoundError:
+            raise TemplateNotFound(template)
+        return source, filename, lambda: self.__sources.is_uptodate(filename)
+
+
+class AnatomySearchLoader(BaseLoader):
+    """
+    The loader of the TemplateEngine environments, used by "{% include %}", "{% import %}" and "{% extends %}".
+
+    Templates used by a template file are loaded from the templates directory of that file (see join_path). Other
+    templates are searched in the templates directories in the order they were first used.
+
+    Usage:
+        loader = AnatomySearchLoader()
+        loader.add(AnatomyTemplateLoader('templates', TemplateSourceCache()))
+        env = AnatomyEnvironment(loader=loader)
+    """
+
+    def __init__(self):
+        self.__loaders = []
+
+    def add(self, loader):
+        """
+        :param AnatomyTemplateLoader loader:
+        """
+        self.__loaders = self.__loaders + [loader]
+
+    def find(self, filename):
+        """
+        Returns the loader of the templates directory containing the given filename.
+
+        :param str filename:
+        :return 2-tuple(AnatomyTemplateLoader, str):
+            Returns the loader and the template name relative to its directory, or None and the given filename.
+        """
+        result = None, filename
+        length = 0
+        for i_loader in self.__loaders:
+            prefix = i_loader.get_filename("")
+            if filename.startswith(prefix) and len(prefix) > length:
+                result = i_loader, filename[len(prefix) :]
+                length = len(prefix)
+        return result
+
+    def join_path(self, template, parent):
+        loader, _name = self.find(parent)
+        if loader is None:
+            return template
+        return loader.get_filename(template)
+
+    def get_source(self, environment, template):
+        loader, name = self.find(template)
+        if loader is not None:
+            return loader.get_source(environment, name)
+        for i_loader in self.__loaders:
+            try:
+                return i_loader.get_source(environment, template)
+            except TemplateNotFound:
+                pass
+        raise TemplateNotFound(template)
+
+
+class AnatomyEnvironment(Environment):
+    """
+    A jinja2 Environment resolving the templates names relative to the parent template (see AnatomySearchLoader).
+    """
+
+    def join_path(self, template, parent):
+        if isinstance(self.loader, AnatomySearchLoader):
+            return self.loader.join_path(template, parent)
+        return template
+
+
+class AnatomyBytecodeCache(FileSystemBytecodeCache):
+    """
+    A persistent jinja2 bytecode cache for the templates on ANATOMY.templates_dir.
+
+    The cache key is computed from the template path, its modification time and the expansion mode. The content hash is
+    stored in each entry by jinja2 and checked when loading, so a modified template is never served from the cache.
+
+    Usage:
+        cache = AnatomyBytecodeCache('~/.cache/zops-anatomy/bytecode')
+        TemplateEngine.get().set_bytecode_cache(cache)
+        ...
+        cache.prune(max_age=7 * 24 * 60 * 60)
+    """
+
+    PATTERN = "__zops_anatomy_%s.cache"
+
+    def __init__(self, directory):
+        directory = os.path.expanduser(directory)
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory, self.PATTERN)
+        self.directory = directory
+
+    def get_bucket(self, environment, name, filename, source):
+        # The same template compiles to different code for each expansion mode.
+        name = "{}|{}".format(name, environment.variable_start_string)
+        return super().get_bucket(environment, name, filename, source)
+
+    def get_cache_key(self, name, filename=None):
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+        except (TypeError, OSError):
+            mtime = 0
+        key = "{}|{}|{}".format(name, filename, mtime)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+        if bucket.code is not None:
+            # Touch the entry so prune keeps the entries in use.
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                pass
+
+    def prune(self, max_age):
+        """
+        Removes the cache entries that were not used in the last max_age seconds.
+
+        Since the key includes the template modification time, entries for old versions of a template are never used
+        again and are removed by this method.
+
+        :param float max_age:
+        :return int:
+            Returns the number of removed entries.
+        """
+        import fnmatch
+
+        limit = time.time() - max_age
+        result = 0
+        for i_name in os.listdir(self.directory):
+            if not fnmatch.fnmatch(i_name, self.PATTERN % "*"):
+                continue
+            filename = os.path.join(self.directory, i_name)
+            try:
+                if os.stat(filename).st_mtime < limit:
+                    os.remove(filename)
+                    result += 1
+            except OSError:
+                pass
+        return result
+
+
+# Pseudo variable path of the templates that include, import or extend other templates (see find_dependencies).
+TEMPLATES_DEPENDENCY = "!templates"
+
+
+def find_dependencies(environment, text):
+    """
+    Returns the variable paths (eg.: "DJANGO.version") read by the given template.
+
+    Attribute and constant subscript chains are followed from the undeclared variables of the template. The chain is
+    truncated on dynamic subscripts and method calls, so the result may be broader than needed.
+
+    Only the given text is analysed: the variables read by the templates it includes, imports or extends are not
+    found, and these templates have the TEMPLATES_DEPENDENCY pseudo path instead. The variables read by template syntax
+    the template output itself creates (eg.: "{{ 'PROJECT.name'|dmustache }}"), expanded in further passes, are only
+    known while rendering (see TemplateEngine.expand stats).
+
+    :param jinja2.Environment environment:
+    :param str text:
+    :return frozenset(str):
+    """
+    from jinja2 import meta, nodes
+
+    TEMPLATE_NODES = (nodes.Include, nodes.Import, nodes.FromImport, nodes.Extends)
+
+    ast = environment.parse(text)
+    undeclared = meta.find_undeclared_variables(ast)
+    result = set()
+
+    def chain(node):
+        """
+        Returns the path for a chain of attributes/items and the dynamic subscripts found on the way.
+        """
+        if isinstance(node, nodes.Name):
+            if node.ctx != "load" or node.name not in undeclared:
+                return None, []
+            return [node.name], []
+        if isinstance(node, nodes.Getattr):
+            path, dynamic = chain(node.node)
+            if path is not None and not dynamic:
+                path = path + [node.attr]
+            return path, dynamic
+        if isinstance(node, nodes.Getitem):
+            path, dynamic = chain(node.node)
+            if path is None:
+                return None, dynamic
+            if dynamic:
+                return path, dynamic + [node.arg]
+            if isinstance(node.arg, nodes.Const) and isinstance(node.arg.value, (str, int)):
+                return path + [str(node.arg.value)], dynamic
+            return path, [node.arg]
+        return None, []
+
+    def visit(node):
+        if isinstance(node, TEMPLATE_NODES):
+            result.add(TEMPLATES_DEPENDENCY)
+        if isinstance(node, nodes.Call) and isinstance(node.node, nodes.Getattr):
+            # Method call (eg.: PROJECT.items()): depends on the object owning the method.
+            path, dynamic = chain(node.node.node)
+            if path is not None:
+                result.add(".".join(path))
+                for i_node in dynamic:
+                    visit(i_node)
+                for i_node in node.iter_child_nodes(exclude=("node",)):
+                    visit(i_node)
+                return
+        if isinstance(node, (nodes.Name, nodes.Getattr, nodes.Getitem)):
+            path, dynamic = chain(node)
+            if path is not None:
+                result.add(".".join(path))
+                for i_node in dynamic:
+                    visit(i_node)
+                return
+        for i_node in node.iter_child_nodes():
+            visit(i_node)
+
+    visit(ast)
+    return frozenset(result)
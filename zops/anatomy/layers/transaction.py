@@ -0,0 +1,239 @@
+import os
+
+from .sinks import UMASK, AnatomyDirectorySink, AnatomySink, mkstemp, write_chunks
+from .tree import CREATED, UNCHANGED, WRITTEN, _read_bytes
+
+
+class AnatomyTransaction(AnatomySink):
+    """
+    A sink that stages files and symlinks in temporary files, next to their targets, and moves all of them into place
+    on commit (close).
+
+    If the commit fails the targets replaced so far are restored, so the directory is left either as it was or with
+    all the changes. Changing only the executable bit of an unchanged file is applied after the commit. Files are
+    written through symlinks, like AnatomyDirectorySink does.
+
+    Usage:
+        with AnatomyTransaction() as transaction:
+            transaction.write('directory/alpha.txt', b'alpha\n')
+            transaction.symlink('directory/bravo.txt', 'alpha.txt')
+    """
+
+    def __init__(self, fsync=True):
+        """
+        :param bool fsync:
+            If False, skips the fsync of the staged files and directories: faster, but the changes may be lost on a
+            system crash.
+        """
+        self.__fsync = fsync
+        self.__staged = []  # (temp filename, target filename)
+        self.__targets = set()
+        self.__executables = []
+        self.__created_dirs = []
+
+    def is_file(self, filename):
+        return os.path.normpath(filename) in self.__targets or os.path.isfile(filename)
+
+    def write(self, filename, contents, executable=False):
+        """
+        Stages the given contents for the given file, unless the file already has these contents.
+
+        :param str filename:
+        :param bytes contents:
+        :param bool executable:
+        :return str:
+            Returns CREATED, WRITTEN or UNCHANGED.
+        """
+        target = os.path.realpath(filename)
+        try:
+            stat = os.stat(target)
+        except FileNotFoundError:
+            result = CREATED
+            mode = 0o666 & ~UMASK
+        else:
+            if stat.st_size == len(contents) and _read_bytes(target) == contents:
+                if executable:
+                    self.make_executable(filename)
+                return UNCHANGED
+            result = WRITTEN
+            mode = stat.st_mode & 0o7777
+        if executable:
+            mode |= (mode & 0o444) >> 2  # copy R bits to X
+
+        fd, temp_filename = self._mkstemp(target)
+        try:
+            write_chunks(fd, temp_filename, [contents], self.__fsync)
+        except Exception as e:
+            raise RuntimeError(e)
+        os.chmod(temp_filename, mode)
+        self._stage(temp_filename, target, filename)
+        return result
+
+    def write_stream(self, filename, chunks, executable=False):
+        """
+        Stages the chunks in a temporary file, unless the file already has these contents.
+        """
+        import filecmp
+
+        target = os.path.realpath(filename)
+        fd, temp_filename = self._mkstemp(target)
+        write_chunks(fd, temp_filename, chunks, self.__fsync)
+
+        try:
+            stat = os.stat(target)
+        except FileNotFoundError:
+            result = CREATED
+            mode = 0o666 & ~UMASK
+        else:
+            if filecmp.cmp(temp_filename, target, shallow=False):
+                os.unlink(temp_filename)
+                if executable:
+                    self.make_executable(filename)
+                return UNCHANGED
+            result = WRITTEN
+            mode = stat.st_mode & 0o7777
+        if executable:
+            mode |= (mode & 0o444) >> 2  # copy R bits to X
+        os.chmod(temp_filename, mode)
+        self._stage(temp_filename, target, filename)
+        return result
+
+    def symlink(self, filename, target):
+        """
+        Stages a symlink pointing to the given (relative) target.
+
+        :param str filename:
+        :param str target:
+        :return str:
+            Returns CREATED, WRITTEN or UNCHANGED.
+        """
+        if os.path.islink(filename):
+            if os.readlink(filename) == target:
+                return UNCHANGED
+            result = WRITTEN
+        elif os.path.lexists(filename):
+            result = WRITTEN
+        else:
+            result = CREATED
+
+        fd, temp_filename = self._mkstemp(filename)
+        os.close(fd)
+        try:
+            os.unlink(temp_filename)
+            os.symlink(target, temp_filename)
+        except Exception as e:
+            raise RuntimeError(e)
+        self._stage(temp_filename, filename)
+        return result
+
+    def make_executable(self, filename):
+        """
+        Sets the executable bits of the given file after the commit.
+
+        :param str filename:
+        """
+        self.__executables.append(filename)
+
+    def commit(self):
+        """
+        Moves the staged files into place. Restores the replaced files and rolls back if any move fails.
+        """
+        committed = []  # (target filename, backup filename)
+        try:
+            for i_temp, i_filename in self.__staged:
+                backup = None
+                if os.path.lexists(i_filename):
+                    backup = self._backup(i_filename)
+                try:
+                    os.replace(i_temp, i_filename)
+                except Exception:
+                    if backup is not None:
+                        os.unlink(backup)
+                    raise
+                committed.append((i_filename, backup))
+        except Exception:
+            for i_filename, i_backup in reversed(committed):
+                if i_backup is None:
+                    os.unlink(i_filename)
+                else:
+                    os.replace(i_backup, i_filename)
+            self.rollback()
+            raise
+        self.__staged = []
+
+        for _filename, i_backup in committed:
+            if i_backup is not None:
+                os.unlink(i_backup)
+
+        if self.__fsync:
+            for i_directory in sorted({os.path.dirname(i) for i, _ in committed}):
+                _fsync_directory(i_directory)
+
+        self.__targets.clear()
+        self.__created_dirs = []
+
+        directory_sink = AnatomyDirectorySink()
+        for i_filename in self.__executables:
+            directory_sink.make_executable(i_filename)
+        self.__executables = []
+
+    close = commit
+
+    def rollback(self):
+        """
+        Discards the staged files (not yet moved) and removes the directories created for them.
+        """
+        for i_temp, _filename in self.__staged:
+            if os.path.lexists(i_temp):
+                os.unlink(i_temp)
+        for i_directory in reversed(self.__created_dirs):
+            try:
+                os.rmdir(i_directory)
+            except OSError:
+                pass
+        self.__staged = []
+        self.__targets.clear()
+        self.__executables = []
+        self.__created_dirs = []
+
+    abort = rollback
+
+    def _stage(self, temp_filename, filename, link=None):
+        """
+        :param str link:
+            The symlink written through, if filename is its resolved target.
+        """
+        self.__staged.append((temp_filename, filename))
+        self.__targets.add(os.path.normpath(filename))
+        if link is not None:
+            self.__targets.add(os.path.normpath(link))
+
+    def _mkstemp(self, filename):
+        self._makedirs(os.path.dirname(filename))
+        return mkstemp(filename)
+
+    def _makedirs(self, directory):
+        if not directory or os.path.isdir(directory):
+            return
+        self._makedirs(os.path.dirname(directory))
+        os.mkdir(directory)
+        self.__created_dirs.append(directory)
+
+    def _backup(self, filename):
+        """
+        Hard-links the given file to a temporary name in the same directory, so it can be restored.
+        """
+        fd, result = mkstemp(filename, suffix=".bak")
+        os.close(fd)
+        os.unlink(result)
+        os.link(filename, result, follow_symlinks=False)
+        return result
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
@@ -1,30 +1,536 @@
 import os
 
 from zerotk.lib.text import dedent
-from collections import OrderedDict
-from collections.abc import MutableMapping
-import distutils.util
+from collections import Counter, OrderedDict
+from collections.abc import Mapping, MutableMapping
+from dataclasses import dataclass
+import threading
+import time
+from typing import NamedTuple
+
+from .profile import NULL_PROFILE
 
 
 class UndefinedVariableInTemplate(KeyError):
     pass
 
 
+# Results of writing a file or symlink (see AnatomySink.write).
+CREATED = "created"
+WRITTEN = "written"
+UNCHANGED = "unchanged"
+
+# Additional results when planning an apply (see AnatomyTree.plan).
+MODIFIED = "modified"
+RETARGETED = "retargeted"
+MODE_CHANGED = "mode-changed"
+
+
+@dataclass
+class AnatomyPlanEntry:
+    """
+    What apply would do to a file (see AnatomyTree.plan).
+    """
+
+    filename: str
+    status: str
+    diff: str = None
+
+
+class AnatomyRecord(NamedTuple):
+    """
+    A rendered file or symlink (see AnatomyTree.iter_render).
+
+    For files, content is the text exactly as apply writes it and symlink is None. For symlinks, content is None and
+    symlink is the target, relative to the symlink directory.
+    """
+
+    path: str
+    content: str
+    executable: bool
+    symlink: str
+
+
+class TemplateExpansionError(RuntimeError):
+    pass
+
+
+class MultiPassTemplate(TemplateExpansionError):
+    """
+    Raised by TemplateEngine.generate when the output of a template needs another expansion pass.
+    """
+
+
+# Memo key of the variable paths read by the expansion passes (see TemplateEngine._expandit).
+_MEMO_DEPENDENCIES = ("dependencies",)
+
+
+class TemplateCache(object):
+    """
+    A bounded LRU cache of compiled templates.
+
+    Usage:
+        cache = TemplateCache(maxsize=100)
+        template = cache.get(key, lambda: env.from_string(text))
+    """
+
+    def __init__(self, maxsize=2048):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def get(self, key, factory):
+        """
+        Returns the value cached for the given key, calling factory to create it on a cache miss.
+
+        :param object key:
+        :param callable factory:
+        :return object:
+        """
+        with self.__lock:
+            try:
+                result = self.__items[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.__items.move_to_end(key)
+                self.hits += 1
+                return result
+
+        result = factory()
+
+        with self.__lock:
+            self.__items[key] = result
+            self.__items.move_to_end(key)
+            while len(self.__items) > self.maxsize:
+                self.__items.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return dict:
+            Returns a dict with the cache hits, misses, current size and maximum size.
+        """
+        return dict(hits=self.hits, misses=self.misses, size=len(self), maxsize=self.maxsize)
+
+
 class TemplateEngine(object):
     """
     Provide an easy and centralized way to change how we expand templates.
+
+    The engine keeps one long-lived jinja2 Environment per expansion mode (normal and alternative). The variables are
+    passed through the render context so the same environment (and its filters) is shared by all expansions and
+    threads.
+
+    Compiled templates are kept in a TemplateCache keyed by source text and expansion mode, so repeated sources
+    (filenames, file contents and the intermediate results of expandit) are compiled only once per process.
+
+    Template files are loaded by an AnatomyTemplateLoader rooted at ANATOMY.templates_dir (see expand_template) and
+    their sources are cached until the file changes. Templates can "{% include %}" and "{% import %}" other templates
+    by their name relative to the templates directory (see AnatomySearchLoader).
+
+    Optionally, the templates loaded from files are also stored in a persistent bytecode cache (see
+    set_bytecode_cache) so repeated runs skip parsing and compiling them.
+
+    The expansion is repeated until the result is stable, but text without template markers is returned without touching
+    jinja2 and the number of iterations is bounded by max_iterations.
+
+    The filters that expand templates (expandit, env_var, is_enabled and the empty test) memoize their results by input
+    text for the duration of a top-level expansion, when the variables don't change. The memo is passed to the
+    templates as the MEMO_VARIABLE variable, so the nested expansions share it.
     """
 
+    # Start strings for blocks, variables and comments for each expansion mode. The carriage return is included because
+    # jinja2 normalizes the newlines of the rendered text.
+    MARKERS = {
+        False: ("{{", "{%", "{#", "\r"),
+        True: ("{{{", "{{%", "{#", "\r"),
+    }
+
+    MEMO_VARIABLE = "__anatomy_memo__"
+
     __singleton = None
+    __singleton_lock = threading.Lock()
 
     @classmethod
     def get(cls):
         if cls.__singleton is None:
-            cls.__singleton = cls()
+            with cls.__singleton_lock:
+                if cls.__singleton is None:
+                    cls.__singleton = cls()
         return cls.__singleton
 
-    def expand(self, text, variables, alt_expansion=False):
-        from jinja2 import Environment, Template, StrictUndefined
+    def __init__(self, max_iterations=32):
+        self.max_iterations = max_iterations
+        self.__environments = {}
+        self.__lock = threading.Lock()
+        self.__templates = TemplateCache()
+        self.__bytecode_cache = None
+        self.__sources = None
+        self.__loaders = {}
+        self.__search_loader = None
+        self.__template_names = {}
+        self.__dependencies = TemplateCache()
+        self.__expressions = TemplateCache()
+
+    @property
+    def templates(self):
+        """
+        The cache of compiled templates.
+
+        :return TemplateCache:
+        """
+        return self.__templates
+
+    def environment(self, alt_expansion=False):
+        """
+        Returns the jinja2 Environment associated with the given expansion mode, creating it on the first call.
+
+        :param bool alt_expansion:
+        :return jinja2.Environment:
+        """
+        alt_expansion = bool(alt_expansion)
+        try:
+            return self.__environments[alt_expansion]
+        except KeyError:
+            pass
+        with self.__lock:
+            result = self.__environments.get(alt_expansion)
+            if result is None:
+                result = self._create_environment(alt_expansion)
+                self.__environments[alt_expansion] = result
+        return result
+
+    @property
+    def bytecode_cache(self):
+        return self.__bytecode_cache
+
+    def set_bytecode_cache(self, bytecode_cache):
+        """
+        Configures the persistent bytecode cache used when compiling templates loaded from files.
+
+        :param AnatomyBytecodeCache|str|None bytecode_cache:
+            A cache instance, a cache directory or None to disable the bytecode cache.
+        """
+        if isinstance(bytecode_cache, str):
+            from .templates import AnatomyBytecodeCache
+
+            bytecode_cache = AnatomyBytecodeCache(bytecode_cache)
+        self.__bytecode_cache = bytecode_cache
+        for i_env in self.__environments.values():
+            i_env.bytecode_cache = bytecode_cache
+
+    def compile(self, text, alt_expansion=False, filename=None):
+        """
+        Returns the compiled template for the given text, using the cache of compiled templates.
+
+        :param str text:
+        :param bool alt_expansion:
+        :param str filename:
+            The file the text was loaded from, if any. The templates it includes are loaded relative to its templates
+            directory and it's stored in the persistent bytecode cache.
+        :return jinja2.Template:
+        """
+        alt_expansion = bool(alt_expansion)
+
+        def create():
+            env = self.environment(alt_expansion)
+            if filename is None:
+                return env.from_string(text)
+            if self.__bytecode_cache is None:
+                code = env.compile(text, filename, filename)
+                return env.template_class.from_code(env, code, env.make_globals(None))
+            return self._compile_cached(env, text, filename)
+
+        return self.__templates.get((text, alt_expansion, filename), create)
+
+    def evaluate(self, expression, variables):
+        """
+        Evaluates the given jinja2 expression (eg.: "PROJECT.python == 'alpha'"). The expression is compiled only once.
+
+        :param str expression:
+        :param dict variables:
+        :return object:
+        :raises UndefinedVariableInTemplate:
+            If the expression uses an undefined variable.
+        """
+        from jinja2.exceptions import UndefinedError
+
+        compiled = self.__expressions.get(
+            expression, lambda: self.environment().compile_expression(expression)
+        )
+        try:
+            return compiled(variables)
+        except UndefinedError as e:
+            raise UndefinedVariableInTemplate(str(e))
+
+    def _compile_cached(self, env, text, filename):
+        bucket = self.__bytecode_cache.get_bucket(env, filename, filename, text)
+        code = bucket.code
+        if code is None:
+            code = env.compile(text, filename, filename)
+            bucket.code = code
+            self.__bytecode_cache.set_bucket(bucket)
+        return env.template_class.from_code(env, code, env.make_globals(None))
+
+    def expand(self, text, variables, alt_expansion=False, stats=None):
+        """
+        Expands the given text until it has no template syntax (see _expandit).
+
+        :param str text:
+        :param dict variables:
+        :param bool alt_expansion:
+        :param dict stats:
+            If given, adds the number of expansion passes to its "iterations" key and the variables read by the
+            passes that expand template syntax created by the expansion itself (which can't be found analysing the
+            text, see dependencies) to its "dependencies" set.
+        :return str:
+        """
+        return self._expandit(text, variables, alt_expansion, stats=stats)
+
+    def expand_template(
+        self, templates_dir, template, variables, alt_expansion=False, stats=None
+    ):
+        """
+        Expands the given template from the templates directory.
+
+        :param str templates_dir:
+        :param str template:
+            The template name, relative to templates_dir.
+        :param dict variables:
+        :param bool alt_expansion:
+        :param dict stats:
+            See expand.
+        :return str:
+        """
+        text, filename = self.get_template_source(templates_dir, template)
+        return self._expandit(
+            text, variables, alt_expansion, filename=filename, stats=stats
+        )
+
+    def generate(self, text, variables, alt_expansion=False, filename=None, stats=None):
+        """
+        Expands the given text in a single pass, yielding the output in chunks as it is rendered.
+
+        Raises MultiPassTemplate, while generating, if the output contains template syntax: in that case the text
+        needs the fixed-point expansion of expand.
+
+        :param str text:
+        :param dict variables:
+        :param bool alt_expansion:
+        :param str filename:
+            See compile.
+        :param dict stats:
+            See expand.
+        :return iter(str):
+        """
+        text = str(text)
+        if not self.has_markers(text, alt_expansion):
+            yield text
+            return
+        template = self.compile(text, alt_expansion, filename=filename)
+        tail = ""
+        memo = {}
+        if stats is not None:
+            memo[_MEMO_DEPENDENCIES] = stats.setdefault("dependencies", set())
+        for i_chunk in template.generate(variables, **{self.MEMO_VARIABLE: memo}):
+            # Checks the end of the previous chunk too, for markers split between chunks.
+            if self.has_markers(tail + i_chunk, alt_expansion):
+                raise MultiPassTemplate(
+                    "Template output needs another expansion: {!r}".format(text[:80])
+                )
+            tail = i_chunk[-2:]
+            yield i_chunk
+
+    def generate_template(
+        self, templates_dir, template, variables, alt_expansion=False, stats=None
+    ):
+        """
+        Like generate, for the given template from the templates directory (see expand_template).
+        """
+        text, filename = self.get_template_source(templates_dir, template)
+        return self.generate(text, variables, alt_expansion, filename, stats)
+
+    def get_template_source(self, templates_dir, template):
+        """
+        Returns the source of the given template from the templates directory.
+
+        :param str templates_dir:
+        :param str template:
+        :return 2-tuple(str, str):
+            Returns the template source and filename.
+        """
+        env = self.environment()
+        text, filename, _uptodate = self.loader(templates_dir).get_source(env, template)
+        return text, filename
+
+    def resolve_template(self, name, variables):
+        """
+        Returns the templates directory and the template name for a template file reference ("!name").
+
+        The result is memoized by templates_dir, ANATOMY.template and name, unless the name itself uses variables.
+
+        :param str name:
+        :param dict variables:
+        :return 2-tuple(str, str):
+        """
+        templates_dir = self.expand("{{ ANATOMY.templates_dir }}", variables)
+        template = self.expand("{{ ANATOMY.template }}", variables)
+        key = (templates_dir, template, name)
+        try:
+            return self.__template_names[key]
+        except KeyError:
+            pass
+        result = (templates_dir, self.expand(f"{template}/{name}", variables))
+        if not self.has_markers(name):
+            self.__template_names[key] = result
+        return result
+
+    def loader(self, templates_dir):
+        """
+        Returns the template loader rooted at the given templates directory.
+
+        :param str templates_dir:
+        :return AnatomyTemplateLoader:
+        """
+        try:
+            return self.__loaders[templates_dir]
+        except KeyError:
+            from .templates import AnatomyTemplateLoader
+
+            sources = self._sources()
+            with self.__lock:
+                result = self.__loaders.get(templates_dir)
+                if result is None:
+                    result = AnatomyTemplateLoader(templates_dir, sources)
+                    self.__loaders[templates_dir] = result
+                    self._search_loader().add(result)
+            return result
+
+    def _search_loader(self):
+        if self.__search_loader is None:
+            from .templates import AnatomySearchLoader
+
+            self.__search_loader = AnatomySearchLoader()
+        return self.__search_loader
+
+    def _sources(self):
+        if self.__sources is None:
+            from .templates import TemplateSourceCache
+
+            with self.__lock:
+                if self.__sources is None:
+                    self.__sources = TemplateSourceCache()
+        return self.__sources
+
+    def dependencies(self, text, alt_expansion=False):
+        """
+        Returns the variable paths (eg.: "DJANGO.version") read by the given text, analysing the jinja2 AST.
+
+        Only the text itself is analysed (see find_dependencies). See expand_dependencies to follow the variables
+        values that are templates.
+
+        :param str text:
+        :param bool alt_expansion:
+        :return frozenset(str):
+        """
+        alt_expansion = bool(alt_expansion)
+        if not self.has_markers(text, alt_expansion):
+            return frozenset()
+
+        def create():
+            from .templates import find_dependencies
+
+            return find_dependencies(self.environment(alt_expansion), text)
+
+        return self.__dependencies.get((text, alt_expansion), create)
+
+    def expand_dependencies(self, paths, variables, alt_expansion=False):
+        """
+        Adds to the given variable paths the dependencies of their values that are templates themselves (that are
+        expanded by the fixed-point expansion or by the expandit filter).
+
+        :param iterable(str) paths:
+        :param dict variables:
+        :param bool alt_expansion:
+        :return frozenset(str):
+        """
+        result = set()
+        pending = list(paths)
+        while pending:
+            path = pending.pop()
+            if path in result:
+                continue
+            result.add(path)
+            for i_text in _iter_strings(get_variable(variables, path, None)):
+                pending.extend(self.dependencies(i_text, alt_expansion))
+        return frozenset(result)
+
+    @classmethod
+    def has_markers(cls, text, alt_expansion=False):
+        """
+        Returns whether the given text contains any template syntax for the given expansion mode.
+
+        :param str text:
+        :param bool alt_expansion:
+        :return bool:
+        """
+        return any(i in text for i in cls.MARKERS[bool(alt_expansion)])
+
+    def _expandit(self, text, variables, alt_expansion, filename=None, stats=None):
+        result = str(text)
+        seen = set()
+        memo = None
+        for i_pass in range(self.max_iterations):
+            if not self.has_markers(result, alt_expansion):
+                return result
+            if memo is None:
+                memo = variables.get(self.MEMO_VARIABLE)
+                nested = memo is not None
+                if not nested:
+                    memo = {}
+                    if stats is not None:
+                        memo[_MEMO_DEPENDENCIES] = stats.setdefault(
+                            "dependencies", set()
+                        )
+                dependencies = memo.get(_MEMO_DEPENDENCIES)
+            # The text of further passes (and of nested expansions, from filters) may be created by the expansion.
+            if dependencies is not None and (i_pass > 0 or nested):
+                dependencies.update(self.dependencies(result, alt_expansion))
+            before = result
+            template = self.compile(result, alt_expansion, filename=filename)
+            result = template.render(variables, **{self.MEMO_VARIABLE: memo})
+            filename = None
+            if stats is not None:
+                stats["iterations"] = stats.get("iterations", 0) + 1
+            if result == before:
+                return result
+            if result in seen:
+                raise TemplateExpansionError(
+                    "Template expansion oscillates: {!r}".format(before[:80])
+                )
+            seen.add(before)
+        raise TemplateExpansionError(
+            "Template expansion did not stabilize after {} iterations: {!r}".format(
+                self.max_iterations, result[:80]
+            )
+        )
+
+    def _create_environment(self, alt_expansion):
+        from jinja2 import StrictUndefined, pass_context
+
+        from .templates import AnatomyEnvironment
 
         if alt_expansion:
             kwargs = dict(
@@ -36,28 +542,47 @@ class TemplateEngine(object):
         else:
             kwargs = {}
 
-        env = Environment(
+        env = AnatomyEnvironment(
             trim_blocks=True,
             lstrip_blocks=True,
             keep_trailing_newline=True,
             undefined=StrictUndefined,
+            loader=self._search_loader(),
+            bytecode_cache=self.__bytecode_cache,
             **kwargs
         )
 
-        def is_empty(text_):
-            return not bool(expandit(text_).strip())
+        # NOTE: Filters that expand templates render using the variables given to the top-level render (context.parent)
+        # instead of the current context, matching the behavior of passing the variables directly. Since these
+        # variables don't change during the render their results are memoized (see MEMO_VARIABLE).
+
+        def memoized(context, key, function, *args):
+            memo = context.parent.get(self.MEMO_VARIABLE)
+            if memo is None:
+                return function(*args)
+            key = (key, alt_expansion)
+            try:
+                return memo[key]
+            except KeyError:
+                result = memo[key] = function(*args)
+                return result
+
+        @pass_context
+        def is_empty(context, text_):
+            return not bool(expandit(context, text_).strip())
 
         env.tests["empty"] = is_empty
 
-        def expandit(text_):
-            before = None
-            result = str(text_)
-            while before != result:
-                before = result
-                result = env.from_string(result, template_class=Template).render(
-                    **variables
-                )
-            return result
+        @pass_context
+        def expandit(context, text_):
+            return memoized(
+                context,
+                ("expandit", str(text_)),
+                self._expandit,
+                text_,
+                context.parent,
+                alt_expansion,
+            )
 
         env.filters["expandit"] = expandit
 
@@ -85,8 +610,9 @@ class TemplateEngine(object):
 
         env.filters["dmustache"] = dmustache
 
-        def env_var(text_):
-            return "${" + expandit(text_) + "}"
+        @pass_context
+        def env_var(context, text_):
+            return "${" + expandit(context, text_) + "}"
 
         env.filters["env_var"] = env_var
 
@@ -107,15 +633,16 @@ class TemplateEngine(object):
         env.filters["spinalcase"] = stringcase.spinalcase
         env.filters["pascalcase"] = stringcase.pascalcase
 
-        def is_enabled(o):
+        def enabled(context, value):
+            result = self.compile(value, alt_expansion).render(context.parent)
+            return strtobool(result)
+
+        @pass_context
+        def is_enabled(context, o):
             result = o.get("enabled", None)
             if result is None:
                 return True
-            result = env.from_string(result, template_class=Template).render(
-                **variables
-            )
-            result = bool(distutils.util.strtobool(result))
-            return result
+            return memoized(context, ("is_enabled", result), enabled, context, result)
 
         env.filters["is_enabled"] = is_enabled
 
@@ -202,8 +729,7 @@ class TemplateEngine(object):
 
         env.filters["dvalues"] = dvalues
 
-        result = expandit(text)
-        return result
+        return env
 
 
 class AnatomyFile(object):
@@ -220,58 +746,304 @@ class AnatomyFile(object):
         self.__content = dedent(contents)
         self.__executable = executable
 
-    def apply(self, directory, variables, filename=None):
+    def apply(self, directory, variables, filename=None, sink=None):
         """
         Create the file using all registered blocks.
         Expand variables in all blocks.
 
         :param directory:
         :param variables:
-        :return:
+        :param AnatomySink sink:
+            See write.
+        :return str:
+            Returns CREATED, WRITTEN or UNCHANGED.
+        """
+        filename, content = self.render(directory, variables, filename)
+        return self.write(filename, content, sink)
+
+    @property
+    def executable(self):
+        return self.__executable
+
+    @property
+    def fileid(self):
+        return self.__filename
+
+    def render(self, directory, variables, filename=None, profile=NULL_PROFILE):
+        """
+        Expands the filename and contents of this file, without writing it.
+
+        :param str directory:
+        :param dict variables:
+        :param str filename:
+            Overrides the filename of this file.
+        :param AnatomyProfile profile:
+            If given, records the time of each phase and the expansion iterations for this file.
+        :return 2-tuple(str, str):
+            Returns the expanded filename and contents.
+        """
+        engine = TemplateEngine.get()
+
+        start = time.perf_counter() if profile else None
+        path = self.get_filename(directory, variables, filename)
+        if profile:
+            profile.add("filename", time.perf_counter() - start, path)
+        stats = profile.file(path)
+        with profile.measure("template", path):
+            template = self.get_template(variables)
+            if template is not None:
+                engine.get_template_source(*template)
+        if stats is not None:
+            stats["fileid"] = self.__filename
+            stats["source"] = self.__filename if template is None else template[1]
+
+        alt_expansion = self._is_alt_expansion(path)
+
+        try:
+            with profile.measure("render", path):
+                if template is None:
+                    content = engine.expand(
+                        self.__content, variables, alt_expansion, stats
+                    )
+                else:
+                    content = engine.expand_template(
+                        *template, variables, alt_expansion, stats
+                    )
+        except Exception as e:
+            raise RuntimeError("ERROR: {}: {}".format(path, e))
+
+        return path, content
+
+    def write(self, filename, content, sink=None):
+        """
+        Writes the rendered contents (see render) in the given filename.
+
+        :param str filename:
+        :param str content:
+        :param AnatomySink sink:
+            Where to write the file. Defaults to the file system (see AnatomyDirectorySink).
+        :return str:
+            Returns CREATED, WRITTEN or UNCHANGED.
+        """
+        if sink is None:
+            from .sinks import AnatomyDirectorySink
+
+            sink = AnatomyDirectorySink()
+        return sink.write(filename, self._normalize(content), self.__executable)
+
+    def get_filename(self, directory, variables, filename=None):
         """
-        expand = TemplateEngine.get().expand
+        Returns the expanded filename for this file in the given directory.
 
+        :param str directory:
+        :param dict variables:
+        :param str filename:
+            Overrides the filename of this file.
+        :return str:
+        """
         filename = filename or self.__filename
         filename = os.path.join(directory, filename)
-        filename = expand(filename, variables)
+        return TemplateEngine.get().expand(filename, variables)
+
+    def get_template(self, variables):
+        """
+        Returns the template used as contents for this file, if any (contents starting with "!").
+
+        :param dict variables:
+        :return 2-tuple(str, str)|None:
+            Returns the templates directory and template name.
+        """
+        if not self.__content.startswith("!"):
+            return None
+        return TemplateEngine.get().resolve_template(self.__content[1:], variables)
 
-        if self.__content.startswith("!"):
-            content_filename = self.__content[1:]
-            template_filename = "{{ ANATOMY.templates_dir }}/{{ ANATOMY.template}}"
-            template_filename = f"{template_filename}/{content_filename}"
-            template_filename = expand(template_filename, variables)
-            content_filename = expand(template_filename, variables)
-            self.__content = open(content_filename).read()
+    def dependencies(self, variables, filename=None):
+        """
+        Returns the variable paths (eg.: "DJANGO.version") this file depends on, including the variables used by its
+        filename and, transitively, by the variables values that are templates.
 
+        :param dict variables:
+        :param str filename:
+            Overrides the filename of this file.
+        :return frozenset(str):
+        """
+        engine = TemplateEngine.get()
+        filename = filename or self.__filename
+        result = set(engine.dependencies(filename))
+        result = engine.expand_dependencies(result, variables)
+
+        template = self.get_template(variables)
+        if template is None:
+            source = self.__content
+        else:
+            result |= {"ANATOMY.templates_dir", "ANATOMY.template"}
+            result |= engine.dependencies(self.__content[1:])
+            source = engine.get_template_source(*template)[0]
+
+        alt_expansion = self._is_alt_expansion(engine.expand(filename, variables))
+        result |= engine.expand_dependencies(
+            engine.dependencies(source, alt_expansion), variables, alt_expansion
+        )
+        return frozenset(result)
+
+    def fingerprint(self, filename, variables, dependencies=()):
+        """
+        Returns a fingerprint of everything that affects the generated file: the contents (or template source), the
+        expanded filename, the executable flag and the values of the variables the file depends on (see dependencies).
+
+        :param str filename:
+            The expanded filename (see get_filename).
+        :param dict variables:
+        :param iterable(str) dependencies:
+            Additional variable paths the file depends on: the ones read by the expansion passes of its last render
+            (see TemplateEngine.expand stats).
+        :return str|None:
+            Returns None for files using other templates (include, import or extend), which are always rendered.
+        """
+        from .manifest import fingerprint
+        from .templates import TEMPLATES_DEPENDENCY
+
+        engine = TemplateEngine.get()
+        paths = self.dependencies(variables)
+        if TEMPLATES_DEPENDENCY in paths:
+            return None
+        if dependencies:
+            paths |= engine.expand_dependencies(dependencies, variables)
+
+        template = self.get_template(variables)
+        if template is None:
+            source = self.__content
+        else:
+            source = engine.get_template_source(*template)[0]
+        values = [(i, get_variable(variables, i, None)) for i in sorted(paths)]
+        return fingerprint(source, filename, self.__executable, values)
+
+    @staticmethod
+    def _is_alt_expansion(filename):
         # Use alternative variable/block expansion when working with Ansible
         # file.
-        alt_expansion = filename.endswith("ansible.yml") or ".github/workflows" in filename
+        return filename.endswith("ansible.yml") or ".github/workflows" in filename
+
+    @staticmethod
+    def _normalize(contents):
+        return AnatomyFile._normalize_text(contents).encode("utf-8")
+
+    def stream(
+        self, directory, variables, filename=None, sink=None, profile=NULL_PROFILE
+    ):
+        """
+        Renders and writes this file chunk by chunk, without keeping the whole contents in memory.
+
+        Templates whose output needs more than one expansion pass (see TemplateEngine.generate) are rendered and
+        written as a whole, like apply.
+
+        :param str directory:
+        :param dict variables:
+        :param str filename:
+            Overrides the filename of this file.
+        :param AnatomySink sink:
+            See write.
+        :param AnatomyProfile profile:
+            If given, records the file stats (see render).
+        :return str:
+            Returns CREATED, WRITTEN or UNCHANGED.
+        """
+        if sink is None:
+            from .sinks import AnatomyDirectorySink
+
+            sink = AnatomyDirectorySink()
+
+        engine = TemplateEngine.get()
+
+        path = self.get_filename(directory, variables, filename)
+        template = self.get_template(variables)
+        stats = profile.file(path)
+
+        alt_expansion = self._is_alt_expansion(path)
 
         try:
-            content = expand(self.__content, variables, alt_expansion)
+            if template is None:
+                chunks = engine.generate(
+                    self.__content, variables, alt_expansion, stats=stats
+                )
+            else:
+                chunks = engine.generate_template(
+                    *template, variables, alt_expansion, stats=stats
+                )
+            chunks = self._normalize_chunks(chunks)
+            return sink.write_stream(path, chunks, self.__executable)
+        except MultiPassTemplate:
+            path, content = self.render(directory, variables, filename, profile)
+            return self.write(path, content, sink)
         except Exception as e:
-            raise RuntimeError("ERROR: {}: {}".format(filename, e))
+            raise RuntimeError("ERROR: {}: {}".format(path, e))
 
-        self._create_file(filename, content)
-        if self.__executable:
-            AnatomyFile.make_executable(filename)
+    @staticmethod
+    def _normalize_chunks(chunks):
+        """
+        Normalizes the contents like _normalize, one chunk at a time, yielding bytes.
 
-    def _create_file(self, filename, contents):
+        Holds back a trailing space (it may be followed by a new-line in the next chunk) and trailing new-lines (they
+        may be the end of the contents).
+        """
+        pending = ""
+        for i_chunk in chunks:
+            text = pending + i_chunk
+            pending = ""
+            if text.endswith(" "):
+                text, pending = text[:-1], " "
+            text = text.replace(" \n", "\n")
+            stripped = text.rstrip("\n")
+            pending = text[len(stripped) :] + pending
+            if stripped:
+                yield stripped.encode("utf-8")
+        yield (pending.replace(" \n", "\n").rstrip("\n") + "\n").encode("utf-8")
+
+    @staticmethod
+    def _normalize_text(contents):
         contents = contents.replace(" \n", "\n")
         contents = contents.rstrip("\n")
         contents += "\n"
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        return contents
+
+    def plan(self, filename, content, diff=False):
+        """
+        Compares the rendered contents (see render) with the given file, without writing it. Like the sinks, a
+        symlink is compared through its target, which is what apply writes.
+
+        :param str filename:
+        :param str content:
+        :param bool diff:
+            If True, includes a unified diff for modified files.
+        :return AnatomyPlanEntry:
+        """
+        content = self._normalize(content)
+        target = os.path.realpath(filename)
         try:
-            with open(filename, "w") as oss:
-                oss.write(contents)
-        except Exception as e:
-            raise RuntimeError(e)
+            stat = os.stat(target)
+        except FileNotFoundError:
+            return AnatomyPlanEntry(filename, CREATED)
+
+        current = None
+        if stat.st_size == len(content):
+            current = _read_bytes(target)
+        if current != content:
+            result = AnatomyPlanEntry(filename, MODIFIED)
+            if diff:
+                current = _read_bytes(target) if current is None else current
+                result.diff = _unified_diff(filename, current, content)
+            return result
+
+        mode = stat.st_mode
+        if self.__executable and mode | (mode & 0o444) >> 2 != mode:
+            return AnatomyPlanEntry(filename, MODE_CHANGED)
+        return AnatomyPlanEntry(filename, UNCHANGED)
 
     @staticmethod
     def make_executable(path):
-        mode = os.stat(path).st_mode
-        mode |= (mode & 0o444) >> 2  # copy R bits to X
-        os.chmod(path, mode)
+        from .sinks import AnatomyDirectorySink
+
+        AnatomyDirectorySink().make_executable(path)
 
 
 class AnatomySymlink(object):
@@ -280,46 +1052,94 @@ class AnatomySymlink(object):
         self.__symlink = symlink
         self.__executable = executable
 
-    def apply(self, directory, variables, filename=None):
+    def apply(self, directory, variables, filename=None, sink=None):
         """
         Create the file using all registered blocks.
         Expand variables in all blocks.
 
         :param directory:
         :param variables:
+        :param AnatomySink sink:
+            See AnatomyFile.write.
         :return:
         """
-        expand = TemplateEngine.get().expand
+        if sink is None:
+            from .sinks import AnatomyDirectorySink
 
-        filename = filename or self.__filename
-        filename = os.path.join(directory, filename)
-        filename = expand(filename, variables)
+            sink = AnatomyDirectorySink()
 
-        symlink = os.path.join(os.path.dirname(filename), self.__symlink)
-        assert os.path.isfile(
+        record = self.render(directory, variables, filename)
+
+        symlink = os.path.join(os.path.dirname(record.path), self.__symlink)
+        assert sink.is_file(symlink), "Can't find symlink destination file: {}".format(
             symlink
-        ), "Can't find symlink destination file: {}".format(symlink)
+        )
 
-        self._create_symlink(filename, symlink)
+        result = sink.symlink(record.path, record.symlink)
         if self.__executable:
-            AnatomyFile.make_executable(filename)
+            sink.make_executable(record.path)
+        return result
 
-    @staticmethod
-    def _create_symlink(filename, symlink):
+    def render(self, directory, variables, filename=None):
+        """
+        Expands the filename and target of this symlink, without creating it.
 
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        try:
-            if os.path.isfile(filename) or os.path.islink(filename):
-                os.unlink(filename)
+        :param str directory:
+        :param dict variables:
+        :param str filename:
+            Overrides the filename of this symlink.
+        :return AnatomyRecord:
+        """
+        filename = self.get_filename(directory, variables, filename)
+        symlink = os.path.join(os.path.dirname(filename), self.__symlink)
+        return AnatomyRecord(
+            filename, None, self.__executable, self._relative_symlink(filename, symlink)
+        )
 
-            # Create a symlink with a relative path (not absolute)
-            path = os.path.normpath(symlink)
-            start = os.path.normpath(os.path.dirname(filename))
-            symlink = os.path.relpath(path, start)
+    @property
+    def fileid(self):
+        return self.__filename
 
-            os.symlink(symlink, filename)
-        except Exception as e:
-            raise RuntimeError(e)
+    def get_filename(self, directory, variables, filename=None):
+        """
+        See AnatomyFile.get_filename.
+        """
+        filename = filename or self.__filename
+        filename = os.path.join(directory, filename)
+        return TemplateEngine.get().expand(filename, variables)
+
+    def dependencies(self, variables, filename=None):
+        """
+        See AnatomyFile.dependencies.
+        """
+        engine = TemplateEngine.get()
+        filename = filename or self.__filename
+        return engine.expand_dependencies(engine.dependencies(filename), variables)
+
+    def plan(self, directory, variables, filename=None):
+        """
+        Compares this symlink with the given directory, without changing it.
+
+        :return AnatomyPlanEntry:
+        """
+        filename = self.get_filename(directory, variables, filename)
+        symlink = self._relative_symlink(
+            filename, os.path.join(os.path.dirname(filename), self.__symlink)
+        )
+        if os.path.islink(filename):
+            if os.readlink(filename) == symlink:
+                return AnatomyPlanEntry(filename, UNCHANGED)
+            return AnatomyPlanEntry(filename, RETARGETED)
+        if os.path.exists(filename):
+            return AnatomyPlanEntry(filename, MODIFIED)
+        return AnatomyPlanEntry(filename, CREATED)
+
+    @staticmethod
+    def _relative_symlink(filename, symlink):
+        # Create a symlink with a relative path (not absolute)
+        path = os.path.normpath(symlink)
+        start = os.path.normpath(os.path.dirname(filename))
+        return os.path.relpath(path, start)
 
 
 class AnatomyTree(object):
@@ -330,11 +1150,15 @@ class AnatomyTree(object):
         tree = AnatomyTree()
         tree.create_file('gitignore', '.gitignore', '.pyc')
         tree.apply('directory')
+
+    :ivar AnatomyProfile profile:
+        If set, apply records its timings there (see AnatomyProfile).
     """
 
     def __init__(self):
-        self.__variables = OrderedDict()
+        self.__variables = AnatomyVariables()
         self.__files = {}
+        self.profile = None
 
     def get_file(self, filename):
         """
@@ -345,23 +1169,276 @@ class AnatomyTree(object):
         """
         return self.__files.setdefault(filename, AnatomyFile(filename))
 
-    def apply(self, directory, variables=None):
+    def apply(
+        self,
+        directory,
+        variables=None,
+        incremental=False,
+        jobs=1,
+        atomic=False,
+        fsync=True,
+        sink=None,
+        streaming=False,
+    ):
         """
         Create all registered files.
 
         :param str directory:
         :param dict variables:
+        :param bool incremental:
+            If True, keeps a manifest (see AnatomyManifest) in the directory and skips, without rendering, the files
+            whose fingerprint didn't change since the last apply.
+        :param int jobs:
+            The number of processes used to render the files. Symlinks are created after all files, in order.
+        :param bool atomic:
+            If True, renders all files before writing any of them. By default they're then written in a transaction
+            (see AnatomyTransaction): a failure leaves the directory unchanged.
+        :param bool fsync:
+            With atomic, whether the written files are synced to disk before they're moved into place.
+        :param AnatomySink sink:
+            Where to write the files. Defaults to the directory (see AnatomyDirectorySink). The given sink is not closed.
+        :param bool streaming:
+            If True, renders and writes each file chunk by chunk (see AnatomyFile.stream), keeping only a chunk of
+            large files in memory. The files are rendered serially, ignoring jobs. With atomic, the chunks are
+            written to the staging files of the transaction.
+        :return Counter:
+            Returns the number of files for each result: CREATED, WRITTEN or UNCHANGED.
         """
-        dd = self.__variables.copy()
-        if variables is not None:
-            dd = merge_dict(dd, variables)
+        import contextlib
+
+        profile = self.profile or NULL_PROFILE
+        with profile.measure("variables"):
+            dd = self._get_variables(variables)
+
+        if incremental:
+            from .manifest import AnatomyManifest
+            from .profile import AnatomyProfile
+
+            if sink is not None:
+                raise ValueError("Incremental apply requires writing to the directory.")
+            manifest = AnatomyManifest.load(directory)
+            # The file stats record the dependencies found while rendering (see AnatomyFile.fingerprint).
+            profile = profile or AnatomyProfile()
+        else:
+            manifest = None
+
+        if sink is not None:
+            context = contextlib.nullcontext(sink)
+        elif atomic:
+            from .transaction import AnatomyTransaction
+
+            context = AnatomyTransaction(fsync=fsync)
+        else:
+            from .sinks import AnatomyDirectorySink
+
+            context = AnatomyDirectorySink()
+
+        files, symlinks, current, fingerprints = self._partition(
+            directory, dd, manifest
+        )
+        result = Counter({UNCHANGED: len(current)} if current else {})
+
+        written = []
+        with context as output:
+            if streaming:
+                for i_file, i_filename in files:
+                    with profile.measure("render"):
+                        status = i_file.stream(
+                            directory, dd, i_filename, output, profile
+                        )
+                    result[status] += 1
+                    if manifest is not None:
+                        written.append(i_file.get_filename(directory, dd, i_filename))
+            else:
+                # Files are written in order as they are rendered, so an error stops the apply at the first failing
+                # file regardless of the number of jobs.
+                rendered = self._render_files(files, directory, dd, jobs, profile)
+                if atomic:
+                    rendered = list(rendered)
+                for (i_file, _filename), (j_path, j_content) in zip(files, rendered):
+                    with profile.measure("write", j_path):
+                        result[i_file.write(j_path, j_content, output)] += 1
+                    written.append(j_path)
+            for i_symlink, i_filename in symlinks:
+                with profile.measure("write"):
+                    result[i_symlink.apply(directory, dd, i_filename, output)] += 1
+
+        if manifest is not None:
+            by_path = {i.get_filename(directory, dd, j): i for i, j in files}
+            for i_path in written:
+                dependencies = sorted(profile.file(i_path).get("dependencies", ()))
+                file_fingerprint = fingerprints[i_path]
+                if dependencies != manifest.dependencies(i_path):
+                    file_fingerprint = by_path[i_path].fingerprint(
+                        i_path, dd, dependencies
+                    )
+                manifest.update(i_path, file_fingerprint, dependencies)
+            manifest.save()
+        return result
+
+    def plan(self, directory, variables=None, diff=False, jobs=1):
+        """
+        Reports what apply would change in the given directory, without writing anything.
+
+        The files are rendered in memory and compared with the directory contents. If the directory has a manifest
+        (see apply incremental parameter) the files recorded as current are reported as unchanged without rendering.
+
+        :param str directory:
+        :param dict variables:
+        :param bool diff:
+            If True, includes an unified diff for each modified file.
+        :param int jobs:
+            See apply.
+        :return list(AnatomyPlanEntry):
+        """
+        from .manifest import AnatomyManifest
+
+        dd = self._get_variables(variables)
+        manifest = AnatomyManifest.load(directory)
+        files, symlinks, current, _fingerprints = self._partition(
+            directory, dd, manifest
+        )
+
+        result = [AnatomyPlanEntry(i, UNCHANGED) for i in current]
+        for (i_file, _filename), (j_path, j_content) in zip(
+            files, self._render_files(files, directory, dd, jobs, self.profile)
+        ):
+            result.append(i_file.plan(j_path, j_content, diff=diff))
+        for i_symlink, i_filename in symlinks:
+            result.append(i_symlink.plan(directory, dd, i_filename))
+        return result
 
+    def iter_render(self, directory, variables=None, jobs=1):
+        """
+        Renders the registered files one at a time, without writing them.
+
+        Yields the files, in registration order, as they're rendered, followed by the symlinks, like apply. Only the
+        file being yielded is kept in memory.
+
+        :param str directory:
+        :param dict variables:
+        :param int jobs:
+            See apply. With more than one job the files are still yielded in order, but the workers may render ahead.
+        :return iter(AnatomyRecord):
+        """
+        dd = self._get_variables(variables)
+        files, symlinks, _current, _fingerprints = self._partition(
+            directory, dd, None
+        )
+        for (i_file, _filename), (j_path, j_content) in zip(
+            files, self._render_files(files, directory, dd, jobs, self.profile)
+        ):
+            yield AnatomyRecord(
+                j_path, i_file._normalize_text(j_content), i_file.executable, None
+            )
+        for i_symlink, i_filename in symlinks:
+            yield i_symlink.render(directory, dd, i_filename)
+
+    def _partition(self, directory, variables, manifest):
+        """
+        Splits the files to apply.
+
+        :return 4-tuple:
+            Returns the files to render and the symlinks, as lists of (file, filename override), the paths of the
+            files that are current according to the manifest and the fingerprints of the files to render.
+        """
+        files = []
+        symlinks = []
+        current = []
+        fingerprints = {}
         for i_fileid, i_file in self.__files.items():
-            try:
-                filename = dd[i_fileid]["filename"]
-            except KeyError:
-                filename = None
-            i_file.apply(directory, variables=dd, filename=filename)
+            filename = self._get_filename(variables, i_fileid)
+            if not isinstance(i_file, AnatomyFile):
+                symlinks.append((i_file, filename))
+                continue
+
+            if manifest is not None:
+                path = i_file.get_filename(directory, variables, filename)
+                file_fingerprint = i_file.fingerprint(
+                    path, variables, manifest.dependencies(path)
+                )
+                if manifest.is_current(path, file_fingerprint):
+                    current.append(path)
+                    continue
+                fingerprints[path] = file_fingerprint
+            files.append((i_file, filename))
+        return files, symlinks, current, fingerprints
+
+    @staticmethod
+    def _render_files(files, directory, variables, jobs, profile=None):
+        """
+        Renders the given files, yielding (filename, contents) in the same order.
+
+        :param AnatomyProfile profile:
+            If given, records the files render stats, collecting them from the worker processes when jobs > 1.
+        """
+        profile = profile or NULL_PROFILE
+        if jobs <= 1 or len(files) <= 1:
+            for i_file, i_filename in files:
+                yield i_file.render(directory, variables, i_filename, profile)
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        bytecode_cache = TemplateEngine.get().bytecode_cache
+        bytecode_cache_dir = getattr(bytecode_cache, "directory", None)
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_render_worker,
+            initargs=(directory, variables, bytecode_cache_dir, bool(profile)),
+        ) as executor:
+            chunksize = max(1, len(files) // (jobs * 4))
+            for i_path, i_content, i_files in executor.map(
+                _render_worker, files, chunksize=chunksize
+            ):
+                profile.update(i_files)
+                yield i_path, i_content
+
+    def _get_variables(self, variables):
+        result = self.__variables
+        if variables is not None:
+            result = result.chain(variables)
+        return result.materialize()
+
+    @staticmethod
+    def _get_filename(variables, fileid):
+        try:
+            return variables[fileid]["filename"]
+        except KeyError:
+            return None
+
+    def dependencies(self, variables=None):
+        """
+        Returns the variable paths each file depends on (see AnatomyFile.dependencies).
+
+        :param dict variables:
+        :return dict(str, frozenset(str)):
+            Maps each file-id to its dependencies.
+        """
+        dd = self._get_variables(variables)
+        return {
+            i_fileid: i_file.dependencies(dd, self._get_filename(dd, i_fileid))
+            for i_fileid, i_file in self.__files.items()
+        }
+
+    def affected_files(self, path, variables=None):
+        """
+        Returns the files affected by a change in the given variable path, without rendering them.
+
+        :param str path:
+            A variable path, eg.: "DJANGO.version".
+        :param dict variables:
+        :return list(str):
+            The file-ids of the affected files.
+        """
+        from .templates import TEMPLATES_DEPENDENCY
+
+        return [
+            i_fileid
+            for i_fileid, i_dependencies in self.dependencies(variables).items()
+            if TEMPLATES_DEPENDENCY in i_dependencies
+            or any(_paths_overlap(path, j) for j in i_dependencies)
+        ]
 
     def create_file(self, filename, contents, executable=False):
         """
@@ -398,10 +1475,285 @@ class AnatomyTree(object):
             If True, the root keys of the new variables (variables parameters) must already exist in the current
             variables dictionary.
         """
-        self.__variables = merge_dict(self.__variables, variables, left_join=left_join)
+        self.__variables.add(variables, left_join=left_join)
 
     def evaluate(self, text):
-        return eval(text, self.__variables)
+        """
+        Evaluates the given expression with this tree variables (see TemplateEngine.evaluate).
+
+        :param str text:
+        :return object:
+        """
+        return TemplateEngine.get().evaluate(text, self.__variables.materialize())
+
+
+_worker_state = {}
+
+
+def _init_render_worker(directory, variables, bytecode_cache_dir, profiling=False):
+    _worker_state["directory"] = directory
+    _worker_state["variables"] = variables
+    _worker_state["profiling"] = profiling
+    if bytecode_cache_dir is not None:
+        TemplateEngine.get().set_bytecode_cache(bytecode_cache_dir)
+
+
+def _render_worker(item):
+    """
+    :return 3-tuple(str, str, dict):
+        Returns the expanded filename, the contents and the file stats (see AnatomyProfile.update), if profiling.
+    """
+    from .profile import AnatomyProfile
+
+    file_, filename = item
+    profile = AnatomyProfile() if _worker_state["profiling"] else NULL_PROFILE
+    try:
+        path, content = file_.render(
+            _worker_state["directory"], _worker_state["variables"], filename, profile
+        )
+        return path, content, getattr(profile, "files", {})
+    except RuntimeError:
+        raise
+    except Exception as e:
+        # Some exceptions (eg.: from jinja2) can't be pickled back to the main process.
+        raise RuntimeError("ERROR: {}: {}".format(filename or "", e))
+
+
+def get_variable(variables, path, default):
+    """
+    Returns the value of the given variable path (eg.: "DJANGO.version") or default if it's not defined.
+
+    :param dict variables:
+    :param str path:
+    :param object default:
+    :return object:
+    """
+    result = variables
+    for i_key in path.split("."):
+        if isinstance(result, Mapping):
+            try:
+                result = result[i_key]
+            except KeyError:
+                return default
+        elif isinstance(result, (list, tuple)) and i_key.isdigit():
+            try:
+                result = result[int(i_key)]
+            except IndexError:
+                return default
+        else:
+            return default
+    return result
+
+
+def strtobool(value):
+    """
+    Converts a string representation of truth to True or False, like the former distutils.util.strtobool.
+
+    :param str value:
+        One of "y", "yes", "t", "true", "on", "1" or "n", "no", "f", "false", "off", "0" (case insensitive).
+    :return bool:
+    """
+    value = value.lower()
+    if value in ("y", "yes", "t", "true", "on", "1"):
+        return True
+    if value in ("n", "no", "f", "false", "off", "0"):
+        return False
+    raise ValueError("invalid truth value {!r}".format(value))
+
+
+def _iter_strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, Mapping):
+        for i_value in value.values():
+            yield from _iter_strings(i_value)
+    elif isinstance(value, (list, tuple)):
+        for i_value in value:
+            yield from _iter_strings(i_value)
+
+
+def _paths_overlap(path1, path2):
+    return (
+        path1 == path2
+        or path1.startswith(path2 + ".")
+        or path2.startswith(path1 + ".")
+    )
+
+
+def _unified_diff(filename, before, after):
+    import difflib
+
+    before = before.decode("utf-8", errors="replace").splitlines(keepends=True)
+    after = after.decode("utf-8", errors="replace").splitlines(keepends=True)
+    return "".join(difflib.unified_diff(before, after, filename, filename))
+
+
+def _read_bytes(filename):
+    with open(filename, "rb") as iss:
+        return iss.read()
+
+
+class AnatomyVariables(Mapping):
+    """
+    A layered variable store, equivalent to merging each added dict with merge_dict.
+
+    The added dicts are kept as layers (not copied) and only merged when the variables are read (see materialize). The
+    merge is done in a single pass over all layers, so adding variables costs only the validation of the first two
+    levels of keys (left_join) and the materialization cost is proportional to the total size of the variables,
+    regardless of the number of layers.
+
+    Usage:
+        variables = AnatomyVariables()
+        variables.add({'PROJECT': {'name': 'alpha'}}, left_join=False)
+        variables.add({'PROJECT': {'name': 'bravo'}})
+        variables['PROJECT']['name'] == 'bravo'
+    """
+
+    def __init__(self, layers=(), keys=None):
+        self.__layers = list(layers)
+        # Keys of the first two levels, used to validate left_join: {root key: set of keys or None (not a dict)}
+        self.__keys = OrderedDict() if keys is None else keys
+        self.__materialized = None
+
+    def add(self, variables, left_join=True):
+        """
+        Adds the given variables as a new layer. See merge_dict for the merge rules.
+
+        :param dict variables:
+        :param bool left_join:
+        """
+        self._update_keys(self.__keys, variables, left_join)
+        self.__layers.append((variables, left_join))
+        self.__materialized = None
+
+    def chain(self, variables, left_join=True):
+        """
+        Returns a new store with the layers of this store plus the given variables. The layers are shared.
+
+        :param dict variables:
+        :param bool left_join:
+        :return AnatomyVariables:
+        """
+        result = self.copy()
+        result.add(variables, left_join=left_join)
+        return result
+
+    def materialize(self):
+        """
+        Returns the merged variables. The result is cached until a new layer is added and must not be modified.
+
+        :return OrderedDict:
+        """
+        if self.__materialized is None:
+            result = OrderedDict()
+            for i_variables, i_left_join in self.__layers:
+                _merge_into(result, i_variables, 0, i_left_join)
+            self.__materialized = result
+        return self.__materialized
+
+    def copy(self):
+        keys = OrderedDict(
+            (i, j if j is None else set(j)) for (i, j) in self.__keys.items()
+        )
+        return AnatomyVariables(self.__layers, keys)
+
+    def __getitem__(self, key):
+        return self.materialize()[key]
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __repr__(self):
+        return "AnatomyVariables({!r})".format(dict(self.materialize()))
+
+    @staticmethod
+    def _update_keys(keys, variables, left_join):
+        """
+        Validates the given variables (left_join) and updates the keys index. The index is not changed on errors.
+        """
+        assert isinstance(
+            variables, dict
+        ), "Parameter d2 must be a dict, not {}. d2={}".format(
+            variables.__class__, variables
+        )
+        cleaned = {i.rstrip("!"): j for (i, j) in variables.items()}
+        if left_join:
+            extra_keys = {i for i in cleaned if i not in keys}
+            if extra_keys:
+                raise RuntimeError("Extra keys: {}".format(extra_keys))
+
+        updates = []
+        for i_key, i_value in cleaned.items():
+            current = keys.get(i_key)
+            if i_value is None:
+                if i_key not in keys:
+                    updates.append((i_key, None))
+            elif i_key + "!" in variables or current is None:
+                if isinstance(i_value, dict):
+                    updates.append((i_key, set(i_value.keys())))
+                else:
+                    updates.append((i_key, None))
+            else:
+                assert isinstance(
+                    i_value, dict
+                ), "Parameter d2 must be a dict, not {}. d2={}".format(
+                    i_value.__class__, i_value
+                )
+                sub_keys = {i.rstrip("!") for i in i_value.keys()}
+                if left_join:
+                    extra_keys = sub_keys.difference(current)
+                    if extra_keys:
+                        raise RuntimeError("Extra keys: {}".format(extra_keys))
+                updates.append((i_key, current | sub_keys))
+
+        for i_key, i_sub_keys in updates:
+            keys[i_key] = i_sub_keys
+
+
+def _merge_into(d1, d2, depth, left_join):
+    """
+    Same as _merge_dict, but merging d2 into d1 in place. Values from d2 are copied, so d1 never shares containers
+    with the merged dicts.
+    """
+    assert isinstance(d2, dict), "Parameter d2 must be a dict, not {}. d2={}".format(
+        d2.__class__, d2
+    )
+    d2_cleaned = {i.rstrip("!"): j for (i, j) in d2.items()}
+
+    if left_join and depth < 2:
+        right_keys = {i for i in d2_cleaned if i not in d1}
+        if right_keys:
+            raise RuntimeError("Extra keys: {}".format(right_keys))
+
+    for i_key, v2 in d2_cleaned.items():
+        v1 = d1.get(i_key)
+        try:
+            if v2 is None:
+                d1.setdefault(i_key, None)
+            elif i_key + "!" in d2:
+                d1[i_key] = _copy_value(v2)
+            elif isinstance(v1, dict):
+                _merge_into(v1, v2, depth + 1, left_join)
+            elif isinstance(v1, list) and isinstance(v2, list):
+                v1.extend(_copy_value(v2))
+            elif isinstance(v1, (list, tuple)):
+                d1[i_key] = _copy_value(v1 + v2)
+            else:
+                d1[i_key] = _copy_value(v2)
+        except AssertionError:
+            print("While merging value for key {}".format(i_key))
+            raise
+
+
+def _copy_value(value):
+    if isinstance(value, dict):
+        return OrderedDict((i, _copy_value(j)) for (i, j) in value.items())
+    if isinstance(value, list):
+        return [_copy_value(i) for i in value]
+    return value
 
 
 def merge_dict(d1, d2, left_join=True):